@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 
 from .db import Db
+from .pool import Pool
 from .query import Query
 from . import dateparse
 from .times import timespan
 from . import config
+from . import cost
 
+import os
 import sys
+from time import time
 from datetime import datetime
 from argparse import ArgumentParser as OptionParser
 from argparse import HelpFormatter as Formatter #IndentedHelpFormatter as Formatter
@@ -45,19 +49,57 @@ class QuasselGrep(object):
 		self.setup_optparser()
 
 		self.server = None
+		self.dimensions = None
+		self.checkpoints = None
+		self.pool = None
+		self.result_cache = None
+		# Where results are written; other output goes to stderr with --format
+		self.results = sys.stdout
 		query = self.run()
 		if query is None:
 			return
 
-		results = query.run()
-		if query.options.debug:
-			for res in results:
-				if res:
-					print(res[0])
-		elif results:
-			for res in results: print(res)
-		else:
-			print("No results found.")
+		start = time()
+		results = None
+		# Where to resume from, after the results written so far
+		token = None
+		try:
+			results = query.run()
+			if query.options.export:
+				# Batches of columns rather than lines (see export.py)
+				try:
+					query.output.write(query.options.export, results)
+				except OSError as e:
+					raise ValueError("Couldn't export results: %s" % (e))
+				print("Exported %d results to %s." % (query.rowcount, query.options.export))
+			else:
+				# Each batch is written at once, while the next is fetched and formatted
+				for lines in results:
+					self.results.write('\n'.join(lines) + '\n')
+					token = getattr(lines, 'token', None) or token
+		except ValueError as e:
+			print("Error: %s" % (e))
+			return
+		except KeyboardInterrupt:
+			query.cancel('Stopped')
+			print("Stopping.", file=sys.stderr)
+			if token:
+				print("To carry on from here, search again with --resume %s" % (token), file=sys.stderr)
+			return
+		except BrokenPipeError:
+			# Whatever was reading the results (head, say) has seen enough
+			query.cancel('Output closed')
+			# Stop Python complaining again when it flushes stdout on exit
+			os.dup2(os.open(os.devnull, os.O_WRONLY), self.results.fileno())
+			return
+		finally:
+			if results is not None:
+				results.close()
+
+		if query.more():
+			print("There may be more results; see them with --resume %s" % (token), file=sys.stderr)
+		if query.options.stats:
+			print_stats(query, start)
 
 	def setup_optparser(self):
 		"""Parse command line arguments using optarg"""
@@ -77,6 +119,22 @@ class QuasselGrep(object):
 		parser.add_option('--dbport', dest='db_port', metavar='PORT',
 						  help='Port of PostGres server')
 
+		parser.add_option('--index', dest='use_index', action='store_true',
+				help='Search using the full-text index (SQLite only, see --build-index)')
+		parser.add_option('--index-file', dest='index_file', metavar='FILE',
+				help='Location of the full-text index (Default: next to the database file)')
+		parser.add_option('--build-index', dest='build_index', action='store_true',
+				help='Build the full-text index and exit')
+		parser.add_option('--sync-index', dest='sync_index', action='store_true',
+				help='Add new messages to the full-text index and exit')
+		parser.add_option('--sync-interval', dest='sync_interval', metavar='SECONDS',
+				help='In server mode, add new messages to the full-text index every SECONDS')
+
+		parser.add_option('--fulltext', dest='fulltext', action='store_true',
+				help='Search for whole words using full-text search (PostgreSQL only, see --setup-indexes)')
+		parser.add_option('--setup-indexes', dest='setup_indexes', action='store_true',
+				help='Create indexes which speed up searches and exit (PostgreSQL only)')
+
 		parser.add_option('-c', '--configfile', dest='config', metavar='FILE',
 				help='Location of config file')
 		parser.add_option('-u', '--username', dest='username', metavar='USER',
@@ -89,16 +147,42 @@ class QuasselGrep(object):
 					  help='Specify the nickname to search for')
 		parser.add_option('-t', '--time', dest='timerange', metavar='RANGE',
 					  help='Time range. See README for details.')
+		parser.add_option('--id-range', dest='id_range', action='store_true',
+					  help='Look up the time range by message ID (fast without a time index, see README)')
 		parser.add_option('-I', '--ignorecase', dest='ignorecase', action='store_true',
         			  help='Ignore case')
 		parser.add_option('-i', '--inclusive', dest='inclusive', action='store_true',
 		              help='Also search for joins, parts, etc.')
 		parser.add_option('-L', '--limit', dest='limit', metavar='NUM',
 		              help='Return at most NUM results')
+		parser.add_option('--page-size', dest='page_size', metavar='NUM',
+				help='Show only the first NUM results, and how to get the ones after them')
+		parser.add_option('--resume', dest='resume', metavar='TOKEN',
+				help='Carry on from where an earlier search stopped')
 
 		parser.add_option('--server', dest='server', action='store_true')
+		parser.add_option('--async', dest='async_server', action='store_true',
+				help='Run the server with asyncio, running at most --workers queries at a time')
+		parser.add_option('--workers', dest='workers', metavar='N',
+				help='Number of threads an --async server runs queries in (Default: 4)')
+		parser.add_option('--max-queries', dest='max_queries', metavar='N',
+				help='Most queries a server runs at once; others wait their turn (Default: 4)')
+		parser.add_option('--max-user-queries', dest='max_user_queries', metavar='N',
+				help='Most queries a server runs at once for any one user (Default: 2)')
+		parser.add_option('--pool-min', dest='pool_min', metavar='N',
+				help='Number of database connections a server opens when it starts (Default: 1)')
+		parser.add_option('--pool-max', dest='pool_max', metavar='N',
+				help='Most database connections a server keeps open at once (Default: 8)')
+		parser.add_option('--cache-size', dest='cache_size', metavar='MB',
+				help='Space used to cache the results of recent searches, in memory for a server or on disk otherwise; 0 to disable (Default: 32)')
+		parser.add_option('--cache-ttl', dest='cache_ttl', metavar='SECONDS',
+				help='How long a server may use cached results for (Default: 300)')
 		parser.add_option('-H', '--host', dest='hostname', help='Connect to quasselgrep server at HOSTNAME')
 		parser.add_option('-p', '--password', dest='password', help='Password your quassel username')
+		parser.add_option('--compress', dest='compress', action='store_true',
+				help='Ask the quasselgrep server to compress results, for slow connections')
+		parser.add_option('--queries', dest='queries', metavar='FILE',
+				help='Run each search in FILE (one per line, after any options for it) over one connection to the server')
 
 		parser.add_option('-l', dest='whole_line', action='store_true',
 				help='Return only results whose message matches the entire search string')
@@ -107,6 +191,28 @@ class QuasselGrep(object):
 
 		parser.add_option('--datetime-format', dest='datetime_format', metavar='STRFTIME',
 				help='Specify the date/time format string for results (see Python strftime)')
+		parser.add_option('--format', dest='format', metavar='[text|jsonl|csv|tsv]',
+				help='Print results as text, or as JSON Lines, CSV or TSV records of their fields for other programs (Default: text)')
+		parser.add_option('--export', dest='export', metavar='FILE.parquet',
+				help='Write results to a Parquet file instead of printing them (needs pyarrow)')
+
+		parser.add_option('--batch-size', dest='batch_size', metavar='ROWS',
+				help='Fetch results from the database this many rows at a time')
+		parser.add_option('--parallel', dest='parallel', metavar='N',
+				help='Split the backlog into N slices and search them at once, on separate database connections')
+		parser.add_option('--serial', dest='serial', action='store_true',
+				help='Fetch, format and print results in turn instead of in parallel threads')
+		parser.add_option('--stats', dest='stats', action='store_true',
+				help='Print the number of results, time taken and peak memory use when finished')
+
+		parser.add_option('--timeout', dest='timeout', metavar='SECONDS',
+				help='Cancel searches which take longer than SECONDS, including the time to print their results')
+		parser.add_option('--max-cost', dest='max_cost', metavar='COST',
+				help='Check the estimated cost of searches before running them, and apply --cost-policy to those '
+				     'costing more than COST')
+		parser.add_option('--cost-policy', dest='cost_policy', metavar='[refuse|warn|limit]',
+				help='What to do with searches costing more than --max-cost: refuse to run them, warn, or show only '
+				     'the last %d results (Default: refuse)' % (cost.LIMIT))
 
 		parser.add_option('--debug', dest='debug', action='store_true',
 				help='Display information about the query instead of running it')
@@ -130,7 +236,11 @@ class QuasselGrep(object):
 
 			if option.dest[:2] == 'db':
 				continue
-			if option.dest in ['hostname', 'config', 'server']:
+			if option.dest in ['hostname', 'config', 'server', 'async_server', 'workers', 'pool_min', 'pool_max',
+			                     'max_queries', 'max_user_queries', 'cache_size', 'cache_ttl', 'index_file',
+			                     'build_index', 'sync_index', 'sync_interval', 'setup_indexes', 'max_cost',
+			                     'cost_policy', 'timeout', 'compress', 'queries', 'parallel', 'export', 'batch_size',
+			                     'serial']:
 				continue
 			self.valid_options.append(option.dest)
 	
@@ -142,8 +252,10 @@ class QuasselGrep(object):
 		args = self.parser.parse_args(namespace=options)
 		return args
 
-	def run(self, options=None, search='', salt=''):
-		"""Main function called from the commandline"""
+	def run(self, options=None, search='', salt='', user=None):
+		"""Main function called from the commandline
+
+		For a server, user is who has already logged in on the connection, if anyone."""
 
 		#Set up command-line and configfile options
 		if options:
@@ -160,33 +272,101 @@ class QuasselGrep(object):
 		if options.keywords:
 			search = ' '.join(options.keywords)
 
+		if options.format != 'text' and not self.server:
+			# Keep everything but the results out of the way of whatever is reading them
+			sys.stdout = sys.stderr
+
 		#Be a client, or a server.
 		if options.hostname and not self.server:
 			from . import client
 			client.start(options, search, self)
 			return
-		if options.server and not self.server:
+		if (options.server or options.async_server) and not self.server:
 			from . import server
+			from .dimensions import Dimensions
+			from .timeindex import Checkpoints
 			self.server = True
+			# Shared between all requests, and not saved
+			self.dimensions = Dimensions()
+			self.checkpoints = Checkpoints()
+			if options.cache_size:
+				from .resultcache import ResultCache
+				self.result_cache = ResultCache(self, int(options.cache_size * 1024 * 1024), options.cache_ttl)
+			try:
+				self.pool = Pool(options, options.pool_min, options.pool_max)
+			except Exception as e:
+				print("Error connecting to database: %s" % (e))
+				return
 			server.start(self, options)
 			return
 
-		db = Db()
+		if options.setup_indexes:
+			from . import pgindex
+			db = Db()
+			try:
+				db.connect(options, readonly=False)
+				pgindex.setup(db.connection)
+			except Exception as e:
+				print("Error: %s" % (e))
+			return
+
 		try:
-			cursor = db.connect(options)
+			if self.pool:
+				db = self.pool.get()
+				cursor = db.cursor(options)
+			else:
+				db = Db()
+				cursor = db.connect(options)
 		except Exception as e:
 			print("Error connecting to database: %s" % (e))
 			return
 
-		#Users connecting to a server need to authenticate
-		if self.server:
+		if options.build_index or options.sync_index:
+			from . import index
+			start = time()
+			try:
+				if options.build_index:
+					count = index.build(db.connection, options.index_file)
+				else:
+					count = index.sync(db.connection, options.index_file)
+			except Exception as e:
+				print("Error updating full-text index: %s" % (e))
+				return
+			print("Indexed %d messages in %.2f seconds." % (count, time() - start))
+			return
+
+		query = None
+		try:
+			query = self.prepare(db, cursor, options, search, salt, user)
+		finally:
+			if query is None:
+				self.release(db)
+		return query
+
+	def prepare(self, db, cursor, options, search, salt, user=None):
+		"""Check the user and options, and create the query"""
+		# Connections from the server's pool may have it attached already
+		if options.use_index and db.index_file != options.index_file:
+			from . import index
+			try:
+				index.attach(db.connection, options.index_file)
+			except ValueError as e:
+				print("Error: %s" % (e))
+				return
+			db.index_file = options.index_file
+
+		#Users connecting to a server need to authenticate, once per connection
+		if self.server and (user is None or options.username != user):
 			from . import server
 			from .util import salt_hash
 			if not options.username or not options.password:
 				raise server.AuthException('You must specify a quassel username and password.')
 
-			cursor.execute('SELECT password FROM quasseluser WHERE username=%s' % (options.param_string), (options.username,))
-			results = cursor.fetchall()
+			# Not the query's cursor, which may only be used once
+			auth_cursor = db.connection.cursor()
+			auth_cursor.execute('SELECT password FROM quasseluser WHERE username=%s' % (options.param_string), (options.username,))
+			results = auth_cursor.fetchall()
+			auth_cursor.close()
 			if len(results) != 1:
 				raise server.AuthException('Incorrect username or password.')
 			if salt_hash(salt, results[0][0]) != options.password:
@@ -218,12 +398,45 @@ class QuasselGrep(object):
 			search = '%%%s%%' % (search)
 
 		#Create and run query
-		query = Query(cursor, options, search, timerange)
+		if options.backends:
+			from .federation import FederatedQuery
+			# Results merged from several databases aren't cached by the server
+			query = Query(cursor, options, search, timerange, self.dimensions, self.checkpoints)
+			query.db = db
+			try:
+				return FederatedQuery(query, search, timerange, options.backends)
+			except ValueError as e:
+				print("Error: %s" % (e))
+				return
+		try:
+			query = Query(cursor, options, search, timerange, self.dimensions, self.checkpoints, self.result_cache)
+		except ValueError as e:
+			print("Error: %s" % (e))
+			return
+		query.db = db
 		return query
 
+	def release(self, db, broken=False):
+		"""Give a connection back to the server's pool once a request is finished with it"""
+		if self.pool:
+			self.pool.put(db, broken)
+
 	def server_request(self, command, socket):
 		pass
 
+def print_stats(query, start):
+	"""Print statistics about a finished query to stderr"""
+	stats = "%d rows in %.2f seconds" % (query.rowcount, time() - start)
+	try:
+		import resource
+	except ImportError:
+		pass
+	else:
+		# Linux reports ru_maxrss in KiB
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		stats += ", peak memory use %.1f MiB" % (peak / 1024.0)
+	print(stats, file=sys.stderr)
+
 def main():
 	program = QuasselGrep()
 
@@ -0,0 +1,78 @@
+"""Microbenchmark of formatting search results
+
+Run with python -m quasselgrep.benchmark. Formats the same synthetic rows,
+as an export of a million results from a recent SQLite database would
+return them, first one at a time with format() (as searches used to), then
+with a Formatter (as they do now), checks that both give the same lines, and
+prints how many rows per second each managed. The database isn't involved,
+so only the cost of formatting is measured."""
+
+import random
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from time import time
+
+from . import output
+from .config import defaults
+from .msgtypes import *
+
+# Roughly how often each type of message turns up in a backlog
+TYPE_WEIGHTS = [(MSG, 80), (ACTION, 3), (NOTICE, 2), (JOIN, 6), (PART, 3), (QUIT, 4), (NICK, 1), (MODE, 1)]
+
+WORDS = ['hello', 'world', 'quassel', 'grep', 'python', 'irc', 'foo', 'bar', 'baz', 'test', u'ümlaut']
+
+def make_rows(count, seed=0):
+	"""Return count rows of (messageid, time in milliseconds, type, message, nick, buffer), in order of time"""
+	rng = random.Random(seed)
+	types = [msg_type for (msg_type, weight) in TYPE_WEIGHTS for i in range(weight)]
+	nicks = ['nick%d' % (i) for i in range(500)]
+	buffers = ['#channel%d' % (i) for i in range(20)] + ['query%d' % (i) for i in range(20)]
+
+	now = int(time() * 1000) - count * 1000
+	rows = []
+	for messageid in range(1, count + 1):
+		# A busy core logs a few messages a second
+		now += rng.randrange(0, 1000)
+		message = ' '.join(rng.choice(WORDS) for i in range(rng.randrange(1, 12)))
+		rows.append((messageid, now, rng.choice(types), message, rng.choice(nicks), rng.choice(buffers)))
+	return rows
+
+def before(rows, datetime_format):
+	"""Format rows one at a time with format()"""
+	return [output.format(datetime_format, datetime.fromtimestamp(row[1] // 1000), row[2], row[3], row[4], row[5])
+	        for row in rows]
+
+def after(rows, datetime_format):
+	"""Format rows with a Formatter, as Query.format_batch does"""
+	formatter = output.Formatter(datetime_format)
+	timestamp = formatter.epoch_timestamp
+	return [formatter.line(timestamp(row[1] // 1000), row[2], row[3], row[4], row[5]) for row in rows]
+
+def measure(function, rows, datetime_format):
+	"""Return the lines formatted by function, and the rows per second it managed"""
+	start = time()
+	lines = function(rows, datetime_format)
+	return lines, len(rows) / max(time() - start, 1e-9)
+
+def main():
+	parser = ArgumentParser(description='Measure how fast search results are formatted')
+	parser.add_argument('--rows', type=int, default=1000000, help='Number of rows to format (Default: 1000000)')
+	parser.add_argument('--datetime-format', dest='datetime_format', default=defaults['datetime_format'],
+	                    metavar='STRFTIME', help='Format for timestamps')
+	options = parser.parse_args()
+
+	print("Making %d rows..." % (options.rows))
+	rows = make_rows(options.rows)
+
+	old_lines, old_rate = measure(before, rows, options.datetime_format)
+	print("format():  %10.0f rows/sec" % (old_rate))
+	new_lines, new_rate = measure(after, rows, options.datetime_format)
+	print("Formatter: %10.0f rows/sec (%.1fx)" % (new_rate, new_rate / old_rate))
+
+	if old_lines != new_lines:
+		print("Error: the lines differ")
+		return 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -1,8 +1,13 @@
+import os
 import sys
 import socket
 from argparse import _StoreFalseAction, _StoreTrueAction
+from shlex import split
+from threading import Thread
 
 from .util import salt_and_hash, getdata, escape
+from . import protocol
+from . import config
 
 def start(options, search, program):
 	if not getattr(options, 'hostname', None):
@@ -12,6 +17,41 @@ def start(options, search, program):
 		print("Error: You must supply a password")
 		return
 
+	searches = [(options, search)]
+	if getattr(options, 'queries', None):
+		try:
+			searches = read_queries(options, program)
+		except (OSError, ValueError) as e:
+			print("Error: %s" % (e))
+			return
+
+	try:
+		while searches:
+			searches = session(options, searches, program)
+	except (EOFError, ConnectionResetError) as e:
+		print("Error: %s" % (e))
+	except BrokenPipeError:
+		# Whatever was reading the results has seen enough, and closing the connection tells the server
+		os.dup2(os.open(os.devnull, os.O_WRONLY), program.results.fileno())
+
+def read_queries(options, program):
+	"""Return the searches listed in the file options.queries, with their options
+
+	Each line is a search, with any options for it first. Options given
+	on the commandline apply to all of them."""
+	searches = []
+	with open(options.queries) as queries:
+		for line in queries:
+			line = line.strip()
+			if not line or line.startswith('#'):
+				continue
+			line_options = program.parser.parse_args(sys.argv[1:] + split(line))
+			config.update_options(line_options)
+			searches.append((line_options, ' '.join(line_options.keywords)))
+	return searches
+
+def session(options, searches, program):
+	"""Run searches over one connection, as many as the server allows, and return any left over"""
 	port = options.port if hasattr(options, 'port') else 9001
 
 	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -23,10 +63,52 @@ def start(options, search, program):
 
 	if response[:5] != 'SALT=':
 		print('Error: Did not understand server response.')
-		return
+		sock.close()
+		return []
 
 	salt = response[5:]
-	options.password = salt_and_hash(salt, options.password)
+	password = salt_and_hash(salt, options.password)
+	negotiation = protocol.request(getattr(options, 'compress', False), len(searches) > 1)
+	sock.sendall(request(program, searches[0], password, negotiation))
+
+	reader = sock.makefile('rb', 65536)
+	try:
+		receiver = protocol.Receiver(reader)
+		if receiver.session:
+			count = len(searches)
+			# Sent while the results of the first come back, so the server never waits for the next search
+			rest = b''.join(request(program, search, password) for search in searches[1:])
+			Thread(target=send, args=(sock, rest), daemon=True).start()
+		else:
+			count = 1
+
+		succeeded = True
+		for i in range(count):
+			try:
+				# With --format, sys.stdout is stderr (see QuasselGrep.run)
+				succeeded = receiver.copy(program.results, sys.stdout)
+			except (EOFError, ConnectionResetError) as e:
+				if not succeeded:
+					# The server hangs up after a failed login
+					return []
+				if receiver.token:
+					raise EOFError('%s. To carry on from here, search again with --resume %s' % (e, receiver.token))
+				raise
+		return searches[count:]
+	finally:
+		reader.close()
+		sock.close()
+
+def send(sock, data):
+	try:
+		sock.sendall(data)
+	except OSError:
+		# The server went away, which the reader will notice
+		pass
+
+def request(program, search, password, extra_lines=[]):
+	"""Return a search, its options and any extra lines to send the server"""
+	options, text = search
 	command = u''
 	for option in program.parser._actions:
 		opt_name = option.dest
@@ -37,6 +119,8 @@ def start(options, search, program):
 		if getattr(options, opt_name) is None:
 			continue
 		value = getattr(options, opt_name)
+		if opt_name == 'password':
+			value = password
 		# A bit hackish: we need a value that will evaluate to false, and str(False) does not.
 		# Ideally we should parse it properly on the server side, but it's hard.
 		if isinstance(value, bool) or isinstance(option, (_StoreTrueAction, _StoreFalseAction)):
@@ -44,12 +128,7 @@ def start(options, search, program):
 
 		command += u'%s=%s\n' % (opt_name, escape(str(value)))
 
-	command += u'SEARCH=%s\n' % (search)
-	sock.sendall(command.encode('utf-8'))
-
-	while True:
-		data = sock.recv(1024)
-		if not data:
-			break
-		sys.stdout.write(data.decode('utf-8'))
-
+	for line in extra_lines:
+		command += u'%s\n' % (line)
+	command += u'SEARCH=%s\n' % (text)
+	return command.encode('utf-8')
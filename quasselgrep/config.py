@@ -10,8 +10,25 @@ defaults = {
 	'db_port' : 5432,
 	'db_password' : None,
 
+	# Other databases to search as well, each a dict of db_* options (see federation.py)
+	'backends' : [],
+
+	'use_index' : False,
+	'index_file' : None,
+
+	'batch_size' : 1000,
+	'workers' : 4,
+	'pool_min' : 1,
+	'pool_max' : 8,
+	'max_queries' : 4,
+	'max_user_queries' : 2,
+	'cost_policy' : 'refuse',
+	'cache_size' : 32,
+	'cache_ttl' : 300,
+
 	'whole_line' : False,
-	'datetime_format' : '%Y-%m-%d %H:%M:%S'
+	'datetime_format' : '%Y-%m-%d %H:%M:%S',
+	'format' : 'text'
 }
 
 def loadconfig(filename, namespace):
@@ -50,14 +67,86 @@ def update_options(options):
 
 	if options.db_type not in ('sqlite', 'postgres'):
 		raise ValueError("dbtype must be one of sqlite or postgres, not '%s'" % (options.db_type))
+	if options.format not in ('text', 'jsonl', 'csv', 'tsv'):
+		raise ValueError("Format must be one of text, jsonl, csv or tsv, not '%s'" % (options.format))
 	if options.context:
 		try:
 			options.context = int(options.context)
 			assert options.context >= 0
 		except:
 			raise ValueError("Context must be a non-negative integer, not %s" % (options.context))
-	if options.db_type == 'sqlite' and options.context:
-		raise ValueError('Printing context is not currently supported with an SQLite database')
+
+	if options.sync_interval:
+		try:
+			options.sync_interval = float(options.sync_interval)
+			assert options.sync_interval > 0
+		except:
+			raise ValueError("Sync interval must be a positive number of seconds, not %s" % (options.sync_interval))
+
+	if options.use_index or options.build_index or options.sync_index or options.sync_interval:
+		if options.db_type != 'sqlite':
+			raise ValueError('The full-text index is only supported with an SQLite database')
+		if not options.index_file:
+			options.index_file = options.db_name + '.fts'
+
+	if options.setup_indexes and options.db_type != 'postgres':
+		raise ValueError('--setup-indexes is only supported with a PostgreSQL database')
+	if options.fulltext and options.db_type != 'postgres':
+		raise ValueError('Full-text search is only supported with a PostgreSQL database (see --index for SQLite)')
+
+	try:
+		options.workers = int(options.workers)
+		assert options.workers > 0
+	except:
+		raise ValueError("Number of workers must be a positive integer, not %s" % (options.workers))
+
+	for option in ['max_queries', 'max_user_queries']:
+		try:
+			setattr(options, option, int(getattr(options, option)))
+			assert getattr(options, option) > 0
+		except:
+			raise ValueError("--%s must be a positive integer, not %s" % (option.replace('_', '-'), getattr(options, option)))
+
+	try:
+		options.pool_min = int(options.pool_min)
+		options.pool_max = int(options.pool_max)
+		assert 0 <= options.pool_min <= options.pool_max and options.pool_max > 0
+	except:
+		raise ValueError("Connection pool sizes must be integers with 0 <= --pool-min <= --pool-max, not %s and %s" %
+		                 (options.pool_min, options.pool_max))
+	# Every search which is running holds a connection, so with fewer they would wait for one forever
+	if options.pool_max < options.max_queries:
+		raise ValueError("--pool-max must be at least --max-queries (%d), not %d" % (options.max_queries, options.pool_max))
+
+	try:
+		options.cache_size = float(options.cache_size)
+		options.cache_ttl = float(options.cache_ttl)
+		assert options.cache_size >= 0 and options.cache_ttl >= 0
+	except:
+		raise ValueError("Cache size and TTL must be non-negative numbers, not %s and %s" %
+		                 (options.cache_size, options.cache_ttl))
+
+	if options.timeout:
+		try:
+			options.timeout = float(options.timeout)
+			assert options.timeout > 0
+		except:
+			raise ValueError("Timeout must be a positive number of seconds, not %s" % (options.timeout))
+
+	if options.max_cost:
+		try:
+			options.max_cost = float(options.max_cost)
+			assert options.max_cost > 0
+		except:
+			raise ValueError("Maximum cost must be a positive number, not %s" % (options.max_cost))
+	if options.cost_policy not in ('refuse', 'warn', 'limit'):
+		raise ValueError("Cost policy must be one of refuse, warn or limit, not '%s'" % (options.cost_policy))
+
+	try:
+		options.batch_size = int(options.batch_size)
+		assert options.batch_size > 0
+	except:
+		raise ValueError("Batch size must be a positive integer, not %s" % (options.batch_size))
 
 	if options.limit:
 		try:
@@ -65,3 +154,40 @@ def update_options(options):
 		except:
 			raise ValueError("Limit must be an integer, not %s" % (options.limit))
 
+	if options.page_size:
+		try:
+			options.page_size = int(options.page_size)
+			assert options.page_size > 0
+		except:
+			raise ValueError("Page size must be a positive integer, not %s" % (options.page_size))
+		if options.limit:
+			raise ValueError("--page-size shows the first results and --limit the last; use one or the other")
+	if options.parallel:
+		try:
+			options.parallel = int(options.parallel)
+			assert options.parallel > 0
+		except:
+			raise ValueError("--parallel must be a positive integer, not %s" % (options.parallel))
+		if options.parallel == 1:
+			options.parallel = None
+	if (options.page_size or options.resume) and options.context:
+		raise ValueError("Results with context can't be split into pages or resumed")
+
+	if options.export:
+		if options.hostname:
+			raise ValueError("--export writes a local file, so can't be used with a server")
+		if options.backends:
+			raise ValueError("Results from more than one database can't be exported")
+
+	if options.backends:
+		if not isinstance(options.backends, list) or not all(isinstance(backend, dict) for backend in options.backends):
+			raise ValueError("backends must be a list of dicts of database options")
+		for backend in options.backends:
+			for key in backend:
+				if not key.startswith('db_') and key not in ('use_index', 'index_file'):
+					raise ValueError("backends can only set database options like db_name, not %s" % (key))
+			if backend.get('db_type', options.db_type) not in ('sqlite', 'postgres'):
+				raise ValueError("dbtype must be one of sqlite or postgres, not '%s'" % (backend['db_type']))
+		if options.context or options.page_size or options.resume:
+			raise ValueError("Results from more than one database can't be shown with context, split into pages or resumed")
+
@@ -0,0 +1,64 @@
+"""Context lines around search results
+
+Context rows have the same columns as normal results, followed by the
+bufferid of the row and the messageid of the result it is context for
+(ctxt_for). The rows around each result form a window, and the windows are
+ordered by result, so overlapping windows in the same buffer can be merged
+as the rows stream past without holding more than one window in memory."""
+
+BUFFERID = -2
+CTXT_FOR = -1
+
+def windows(query, hits):
+	"""Fetch the context window around each row of hits
+
+	Each window is looked up separately from the (bufferid, messageid) index,
+	so this costs a couple of small queries per result rather than a scan of
+	the whole backlog, which suits databases without window functions."""
+	cursor = query.cursor.connection.cursor()
+	before_query = query.neighbour_query(before=True)
+	after_query = query.neighbour_query(before=False)
+
+	for hit in hits:
+		messageid = hit[0]
+		bufferid = hit[-1]
+
+		cursor.execute(before_query, (bufferid, messageid))
+		before = cursor.fetchall()
+		before.reverse()
+		cursor.execute(after_query, (bufferid, messageid))
+		after = cursor.fetchall()
+
+		for row in before + [hit] + after:
+			yield tuple(row) + (messageid,)
+
+def merge_windows(rows):
+	"""Merge overlapping context windows
+
+	Yields the rows of each window, except those already yielded as part of
+	the previous window, and None between windows which do not overlap."""
+	ctxt_for = None
+	bufferid = None
+	previous_ids = set()
+	window_ids = set()
+
+	for row in rows:
+		messageid = row[0]
+
+		if row[CTXT_FOR] != ctxt_for:
+			# Windows are contiguous and ordered, so if the new window overlaps the previous one
+			# its first row is in it. Nothing earlier can overlap unless the previous window does.
+			overlaps = row[BUFFERID] == bufferid and messageid in window_ids
+			if ctxt_for is not None and not overlaps:
+				yield None
+
+			previous_ids = window_ids if overlaps else set()
+			window_ids = set()
+			ctxt_for = row[CTXT_FOR]
+			bufferid = row[BUFFERID]
+
+		window_ids.add(messageid)
+		if messageid in previous_ids:
+			continue
+
+		yield row
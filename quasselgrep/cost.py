@@ -0,0 +1,105 @@
+"""Estimating how expensive a query is before running it
+
+PostgreSQL's planner gives an estimated cost for the whole query, in its own
+units (reading a page from disk costs about 1.) SQLite's planner only says
+how it will read each table, so there the estimate is the number of backlog
+rows it will have to look at: all of them if it scans the table, the size
+of the range if it searches by message ID (with --index, only the messages
+not yet in the full-text index), and the share of the backlog in the
+buffers searched if it uses the buffer index. See --max-cost."""
+
+import re
+
+from .timeindex import id_bounds
+
+# Number of results a search is cut down to under the 'limit' policy
+LIMIT = 1000
+
+backlogre = re.compile(r'(?P<kind>SCAN|SEARCH)( TABLE)? backlog\b(?P<how>.*)')
+
+def explain(query, sql, params):
+	"""Return the database's plan for running sql as lines of text"""
+	cursor = query.cursor.connection.cursor()
+	if query.options.db_type == 'postgres':
+		cursor.execute('EXPLAIN ' + sql, params)
+		lines = [row[0] for row in cursor.fetchall()]
+	else:
+		cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+		# Rows are (id, parent id, unused, detail); indent each step under its parent
+		depths = {0: 0}
+		lines = []
+		for row in cursor.fetchall():
+			depths[row[0]] = depths.get(row[1], 0) + 1
+			lines.append('  ' * (depths[row[0]] - 1) + row[3])
+	cursor.close()
+	return lines
+
+def estimate(query, sql, params):
+	"""Return the estimated cost of running sql, and where the estimate comes from"""
+	cursor = query.cursor.connection.cursor()
+	try:
+		if query.options.db_type == 'postgres':
+			return postgres_estimate(cursor, sql, params)
+		return sqlite_estimate(query, cursor, sql, params)
+	finally:
+		cursor.close()
+
+def postgres_estimate(cursor, sql, params):
+	cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+	plan = cursor.fetchone()[0][0]['Plan']
+	return (plan['Total Cost'], 'estimated by PostgreSQL to return %d rows' % (plan['Plan Rows']))
+
+def watermark_steps(rows):
+	"""Return the IDs of plan steps which also look up how far the full-text index goes
+
+	With --index, messages logged since the index was last synced are searched
+	by message ID, starting from that point (see index.TEXT_CLAUSE)."""
+	parents = dict((row[0], row[1]) for row in rows)
+	steps = set()
+	for row in rows:
+		# The lookup is in a subquery, next to the search of the backlog in its branch of the OR
+		if 'fts.indexinfo' in row[3] and parents.get(row[1]):
+			steps.add(parents[row[1]])
+	return steps
+
+def sqlite_estimate(query, cursor, sql, params):
+	cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+	rows = cursor.fetchall()
+	low, high = id_bounds(cursor)
+	total = high - low + 1 if high else 0
+
+	watermarked = watermark_steps(rows)
+	if watermarked:
+		from . import index
+		watermark = index.get_info(cursor.connection, 'last_messageid') or 0
+
+	cost, reason = 0, 'no backlog rows to read'
+	for row in rows:
+		match = backlogre.match(row[3])
+		if not match:
+			continue
+
+		how = match.group('how')
+		if match.group('kind') == 'SCAN':
+			step = (total, 'the whole backlog')
+		elif 'rowid=' in how:
+			# Looking up individual messages, found in the full-text index
+			step = (0, 'messages found in the full-text index')
+		elif 'rowid' in how and row[1] in watermarked:
+			first = max(getattr(query, 'minid', None) or low, low, watermark + 1)
+			last = min(getattr(query, 'maxid', None) or high + 1, high + 1)
+			step = (max(last - first, 0), 'messages logged since the full-text index was synced')
+		elif 'rowid' in how:
+			first = max(getattr(query, 'minid', None) or low, low)
+			last = min(getattr(query, 'maxid', None) or high + 1, high + 1)
+			step = (max(last - first, 0), 'a range of message IDs')
+		elif 'bufferid' in how and getattr(query, 'bufferids', None):
+			# Assume messages are spread evenly between buffers
+			share = float(len(query.bufferids)) / max(len(query.dimensions.buffers), 1)
+			step = (int(total * min(share, 1)), 'the backlog of %d buffers' % (len(query.bufferids)))
+		else:
+			step = (total, 'the backlog, searched%s' % (how))
+
+		if step[0] >= cost:
+			cost, reason = step
+	return (cost, 'reading %s' % (reason))
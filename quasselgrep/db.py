@@ -1,17 +1,32 @@
 
+import os
+from pathlib import Path
+
+def sqlite_uri(path, mode='ro'):
+	"""Return a URI for opening the SQLite database at path with the given mode"""
+	return '%s?mode=%s' % (Path(os.path.abspath(path)).as_uri(), mode)
+
 class Db(object):
 	def __init__(self):
-		pass
+		self.connection = None
+		self.details = {}
+		self.index_file = None
+
+	def connect(self, options, readonly=True):
+		"""Connect to the database specified in options and return a cursor
 
-	def connect(self, options):
+		Also records details of the database needed to query it in options.
+		A PostgreSQL connection may be opened for writing, in autocommit mode,
+		for administrative commands."""
 		if options.db_type == 'sqlite':
-			options.param_string = '?'
+			self.details['param_string'] = '?'
 			try:
 				import sqlite3 as dbmodule
 			except ImportError:
 				raise ValueError('Cannot open an sqlite database without sqlite3 python module')
 
-			self.connection = dbmodule.connect(options.db_name, check_same_thread=False)
+			# Quassel's database is only ever read, never written.
+			self.connection = dbmodule.connect(sqlite_uri(options.db_name), uri=True, check_same_thread=False)
 			cursor = self.connection.cursor()
 
 			cursor.execute('SELECT value FROM coreinfo WHERE key="schemaversion"')
@@ -20,11 +35,12 @@ class Db(object):
 				raise ValueError('Incorrect schemaversion format')
 			try:
 				#Schema version should be an integer, but this isn't guaranteed
-				options.schemaversion = int(results[0][0])
+				self.details['schemaversion'] = int(results[0][0])
 			except ValueError as e:
 				raise ValueError('Unexpected schemaversion %s, not an integer: %s' % (results[0][0], e))
+			self.details['search_indexes'] = set()
 		elif options.db_type == 'postgres':
-			options.param_string = '%s'
+			self.details['param_string'] = '%s'
 			try:
 				import psycopg2 as dbmodule
 			except ImportError:
@@ -34,12 +50,49 @@ class Db(object):
 			                                   user=options.db_user,
 			                                   password=options.db_password,
 			                                   host=options.db_host)
+			if not readonly:
+				self.connection.autocommit = True
+				self.describe(options)
+				return self.connection.cursor()
+
 			try:
 				self.connection.set_session(readonly=True)
 			except AttributeError:
 				pass
-			cursor = self.connection.cursor(name='quasselgrep')
+
+			from . import pgindex
+			self.details['search_indexes'] = pgindex.available(self.connection)
 		else:
 			raise ValueError('Invalid database type: %s' % (options.db_type))
 
-		return cursor
+		self.db_type = options.db_type
+		return self.cursor(options)
+
+	def describe(self, options):
+		"""Record the details of the database in options"""
+		for (key, value) in self.details.items():
+			setattr(options, key, value)
+
+	def cursor(self, options):
+		"""Return a new cursor for a query, and record the details of the database in options"""
+		self.describe(options)
+		if self.db_type == 'postgres':
+			# Named cursors fetch results from the server as they are needed
+			return self.connection.cursor(name='quasselgrep')
+		return self.connection.cursor()
+
+	def check(self):
+		"""Raise an exception unless the connection still works"""
+		cursor = self.connection.cursor()
+		cursor.execute('SELECT 1')
+		cursor.fetchall()
+		cursor.close()
+
+	def reset(self):
+		"""End any transaction, ready for the next query"""
+		self.connection.rollback()
+
+	def close(self):
+		if self.connection is not None:
+			self.connection.close()
+			self.connection = None
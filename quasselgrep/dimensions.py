@@ -0,0 +1,142 @@
+"""Cache of the names of buffers, networks and senders
+
+The backlog refers to buffers and senders by ID. Rather than joining their
+tables onto every row of the results, the names are looked up here. The
+server keeps one cache in memory; the commandline saves it to disk between
+runs. Buffers and networks are few, and can be renamed, so they are all
+reloaded before every search. There can be very many senders, so they are
+fetched as they are needed, with the nick already extracted from the mask.
+Sender rows never change, so their cache is only thrown away if the highest
+senderid goes down (meaning IDs may have been reused.)"""
+
+import os
+import re
+import pickle
+from hashlib import sha1
+from threading import Lock
+
+CACHE_DIR = os.path.expanduser('~/.cache/quasselgrep')
+
+maskre = re.compile('(?P<nick>.*)!(.*)@(.*)')
+
+def cache_path(options, kind='dimensions'):
+	"""Return the path of a cache file of the given kind for the database in options"""
+	database = '%s:%s:%s:%s' % (options.db_type, options.db_host, options.db_port, options.db_name)
+	return os.path.join(CACHE_DIR, '%s-%s.pickle' % (kind, sha1(database.encode('utf-8')).hexdigest()[:16]))
+
+def parse_mask(mask):
+	"""Return the nick part of a nick!user@host mask"""
+	match = maskre.match(mask)
+	if match:
+		return match.group('nick')
+	return mask
+
+class PickledCache(object):
+	"""Base for caches which can be kept in memory or saved to a file
+
+	Subclasses implement get_state and set_state, and set self.changed when
+	their state changes."""
+	version = 1
+
+	def __init__(self, path=None):
+		self.path = path
+		self.lock = Lock()
+		self.changed = False
+
+	@classmethod
+	def load(cls, path):
+		"""Load the cache from path, or return an empty cache if that isn't possible"""
+		cache = cls(path)
+		try:
+			with open(path, 'rb') as fd:
+				version, state = pickle.load(fd)
+		except Exception:
+			return cache
+
+		if version == cls.version:
+			cache.set_state(state)
+		return cache
+
+	def save(self):
+		"""Save the cache to disk if it has a path and has changed"""
+		if not self.path or not self.changed:
+			return
+
+		with self.lock:
+			state = self.get_state()
+		try:
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			with open(self.path + '.tmp', 'wb') as fd:
+				pickle.dump((self.version, state), fd, pickle.HIGHEST_PROTOCOL)
+			os.replace(self.path + '.tmp', self.path)
+		except OSError:
+			# The cache is only an optimisation
+			return
+		self.changed = False
+
+class Dimensions(PickledCache):
+	version = 2
+
+	def __init__(self, path=None):
+		PickledCache.__init__(self, path)
+		self.buffers = {}   # bufferid -> (buffername, networkid)
+		self.networks = {}  # networkid -> networkname
+		self.senders = {}   # senderid -> (nick, mask)
+		self.watermarks = {}
+
+	def get_state(self):
+		return (self.buffers, self.networks, self.senders, self.watermarks)
+
+	def set_state(self, state):
+		self.buffers, self.networks, self.senders, self.watermarks = state
+
+	def watermark(self, cursor, table, column):
+		"""Return the highest ID in table, and whether it has changed"""
+		cursor.execute('SELECT MAX(%s) FROM %s' % (column, table))
+		mark = cursor.fetchone()[0]
+		previous = self.watermarks.get(table)
+		self.watermarks[table] = mark
+		return mark, mark != previous
+
+	def refresh(self, connection):
+		"""Bring the cache up to date with the database"""
+		cursor = connection.cursor()
+		with self.lock:
+			cursor.execute('SELECT bufferid, buffername, networkid FROM buffer')
+			self.buffers = dict((row[0], (row[1], row[2])) for row in cursor.fetchall())
+			cursor.execute('SELECT networkid, networkname FROM network')
+			self.networks = dict(cursor.fetchall())
+
+			previous = self.watermarks.get('sender')
+			mark, changed = self.watermark(cursor, 'sender', 'senderid')
+			if changed and previous and (mark or 0) < previous:
+				self.senders = {}
+				self.changed = True
+		cursor.close()
+
+	def fetch_senders(self, connection, param_string, senderids):
+		"""Make sure the cache contains all of senderids"""
+		missing = [senderid for senderid in senderids if senderid not in self.senders]
+		if not missing:
+			return
+
+		cursor = connection.cursor()
+		query = 'SELECT senderid, sender FROM sender WHERE senderid IN (%s)' % (', '.join([param_string] * len(missing)))
+		cursor.execute(query, missing)
+		with self.lock:
+			for senderid, mask in cursor.fetchall():
+				self.senders[senderid] = (parse_mask(mask), mask)
+			self.changed = True
+		cursor.close()
+
+	def sender(self, senderid):
+		"""Return (nick, mask) of a sender"""
+		return self.senders.get(senderid, (str(senderid), str(senderid)))
+
+	def buffer(self, bufferid):
+		"""Return (buffername, networkname) of a buffer"""
+		try:
+			buffername, networkid = self.buffers[bufferid]
+		except KeyError:
+			return (str(bufferid), None)
+		return (buffername, self.networks.get(networkid))
@@ -0,0 +1,107 @@
+"""Exporting search results to Parquet files, for analysis elsewhere
+
+With --export FILE.parquet, each batch of rows fetched from the database is
+turned into an Arrow record batch of columns in the formatting thread, in
+place of lines of text, and the record batches are written out as row
+groups of about ROW_GROUP_SIZE rows. Only a few batches are held at once, so
+memory use doesn't grow with the number of results.
+
+Times are stored as int64 milliseconds since the epoch, whichever database
+the results came from. Nicks, buffers and networks repeat a lot, so they are
+dictionary-encoded. With context, a ctxt_for column holds the messageid of
+the result each row is context for.
+
+This needs pyarrow, which isn't needed for anything else; install it with
+pip install quasselgrep[Parquet]."""
+
+import os
+
+from . import context
+
+ROW_GROUP_SIZE = 65536
+
+class Exporter(object):
+	"""Turns batches of rows into Arrow record batches, and writes them to a Parquet file"""
+	def __init__(self, options):
+		try:
+			import pyarrow
+			import pyarrow.parquet
+		except ImportError:
+			raise ValueError('Exporting to Parquet needs pyarrow (pip install quasselgrep[Parquet])')
+		self.pa = pyarrow
+		self.parquet = pyarrow.parquet
+		self.options = options
+
+		names = self.pa.dictionary(self.pa.int32(), self.pa.string())
+		fields = [
+			('messageid', self.pa.int64()),
+			('time', self.pa.int64()),
+			# Message types are bit flags up to 0x20000, too large for 16 bits
+			('type', self.pa.int32()),
+			('nick', names),
+			('mask', self.pa.string()),
+			('buffer', names),
+			('network', names),
+			('message', self.pa.string()),
+		]
+		if options.context:
+			fields.append(('ctxt_for', self.pa.int64()))
+		self.schema = self.pa.schema(fields)
+
+	def times(self, rows):
+		"""Return the times of rows in milliseconds since the epoch"""
+		if self.options.db_type == 'postgres':
+			return [int(round(row[1].timestamp() * 1000)) for row in rows]
+		# Quassel schemaversion >=31 has timestamps in milliseconds.
+		if self.options.schemaversion >= 31:
+			return [row[1] for row in rows]
+		return [row[1] * 1000 for row in rows]
+
+	def batch(self, query, rows):
+		"""Return a record batch of rows, found by query"""
+		pa = self.pa
+		# Records have ctxt_for instead of separators between windows of context
+		rows = [row for row in rows if row is not None]
+		query.rowcount += len(rows)
+
+		senders = [query.dimensions.sender(row[4]) for row in rows]
+		buffers = [query.dimensions.buffer(row[5]) for row in rows]
+		columns = [
+			pa.array([row[0] for row in rows], pa.int64()),
+			pa.array(self.times(rows), pa.int64()),
+			pa.array([row[2] for row in rows], pa.int32()),
+			pa.array([sender[0] for sender in senders], pa.string()).dictionary_encode(),
+			pa.array([sender[1] for sender in senders], pa.string()),
+			pa.array([buffer[0] for buffer in buffers], pa.string()).dictionary_encode(),
+			pa.array([buffer[1] for buffer in buffers], pa.string()).dictionary_encode(),
+			pa.array([row[3] for row in rows], pa.string()),
+		]
+		if self.options.context:
+			columns.append(pa.array([row[context.CTXT_FOR] for row in rows], pa.int64()))
+		return pa.RecordBatch.from_arrays(columns, schema=self.schema)
+
+	def write(self, path, batches):
+		"""Write the record batches to a Parquet file at path
+
+		The file only appears once it is complete."""
+		tmp = '%s.%d.tmp' % (path, os.getpid())
+		finished = False
+		try:
+			writer = self.parquet.ParquetWriter(tmp, self.schema)
+			with writer:
+				pending = []
+				count = 0
+				for batch in batches:
+					pending.append(batch)
+					count += batch.num_rows
+					if count >= ROW_GROUP_SIZE:
+						writer.write_table(self.pa.Table.from_batches(pending, self.schema))
+						pending = []
+						count = 0
+				if pending:
+					writer.write_table(self.pa.Table.from_batches(pending, self.schema))
+			os.replace(tmp, path)
+			finished = True
+		finally:
+			if not finished and os.path.exists(tmp):
+				os.remove(tmp)
@@ -0,0 +1,160 @@
+"""Searching more than one database at once
+
+Besides the main database, the config file can list other backends to search,
+such as old SQLite snapshots of a core which now uses PostgreSQL:
+
+	config = {
+		'db_type' : 'postgres',
+		...
+		'backends' : [
+			{'db_type' : 'sqlite', 'db_name' : '/backups/quassel-2019.sqlite'},
+			{'db_type' : 'sqlite', 'db_name' : '/backups/quassel-2021.sqlite'},
+		],
+	}
+
+Each backend is searched with its own connection and query, so everything
+which depends on the database (its schema version, indexes, and the names of
+buffers and senders) is handled separately, and they are all searched at
+once in their own threads. The results are merged in order of time. Where
+snapshots overlap, the same message is found in more than one database, so
+a message is only shown as many times as it was found in any one of them,
+comparing its time (to the second), buffer, sender, type and text."""
+
+from collections import deque
+from copy import copy
+from heapq import merge
+
+from .db import Db
+from .pipeline import Stage
+
+def describe(backend):
+	"""Return a short name for a backend, for messages"""
+	return backend.get('db_name') or backend.get('db_host') or 'backend'
+
+class FederatedQuery(object):
+	"""Looks like a Query, but searches the main database and every one of the backends"""
+	def __init__(self, query, text, timerange, backends):
+		from .query import Query
+
+		self.main = query
+		self.options = query.options
+		self.queries = [query]
+		self.names = [self.options.db_name]
+		self.dbs = []
+		self.rowcount = 0
+		self.abandoned = None
+		self.token = None
+
+		try:
+			for backend in backends:
+				options = copy(self.options)
+				# The main database's full-text index is no use for the others
+				options.use_index = False
+				options.index_file = None
+				for key, value in backend.items():
+					setattr(options, key, value)
+
+				db = Db()
+				self.dbs.append(db)
+				try:
+					cursor = db.connect(options)
+					if options.use_index:
+						from . import index
+						index.attach(db.connection, options.index_file or options.db_name + '.fts')
+				except Exception as e:
+					raise ValueError("Couldn't search %s: %s" % (describe(backend), e))
+				self.queries.append(Query(cursor, options, text, timerange))
+				self.names.append(describe(backend))
+		except:
+			self.close()
+			raise
+
+	@property
+	def db(self):
+		"""The connection to the main database, given back to the server's pool afterwards"""
+		return self.main.db
+
+	def close(self):
+		for db in self.dbs:
+			db.close()
+		self.dbs = []
+
+	def cancel(self, reason='Search cancelled'):
+		for query in self.queries:
+			query.cancel(reason)
+
+	def more(self):
+		return False
+
+	def search(self, query, errors):
+		"""Iterable returning the batches of results from one database, run in its own thread"""
+		query.keyed = True
+		query.abandoned = self.abandoned
+		try:
+			for lines in query.run():
+				yield lines
+		except ValueError as e:
+			# Perhaps the buffer or sender searched for isn't in every database
+			errors.append((query, e))
+
+	def run(self):
+		"""Iterable returning lists of formatted results from all the databases, in order of time"""
+		errors = []
+		stages = [Stage(self.search(query, errors)) for query in self.queries]
+		finished = False
+		try:
+			for stage in stages:
+				stage.start()
+
+			streams = [self.items(stage, index) for (index, stage) in enumerate(stages)]
+			lines = self.deduplicate(merge(*streams, key=lambda item: item[0][0]))
+			if self.main.limit:
+				# Each database found its last results
+				lines = iter(deque(lines, self.main.limit))
+
+			# The header of CSV or TSV, which the main database's query leaves out like the others
+			batch = [self.main.header] if self.main.header else []
+			for line in lines:
+				batch.append(line)
+				self.rowcount += 1
+				if len(batch) >= self.options.batch_size:
+					yield batch
+					batch = []
+			if batch:
+				yield batch
+			finished = True
+		finally:
+			for stage in stages:
+				stage.stop()
+			if not finished:
+				self.cancel()
+			for stage in stages:
+				if stage.is_alive():
+					stage.join()
+			self.close()
+
+		if len(errors) == len(self.queries):
+			raise errors[0][1]
+		for (query, error) in errors:
+			print("Warning: Nothing found in %s: %s" % (self.names[self.queries.index(query)], error))
+
+	def items(self, batches, index):
+		"""Iterable returning (key, line, index) for each line in batches from the database at index"""
+		for lines in batches:
+			for (key, line) in zip(lines.keys, lines):
+				yield (key, line, index)
+
+	def deduplicate(self, items):
+		"""Pass on the lines of (key, line, index) items in order of time, leaving out messages found in other databases
+
+		A message is passed on as many times as it was found in whichever
+		database has it most often, so repeated messages aren't lost."""
+		second = None
+		for (key, line, index) in items:
+			if key[0] != second:
+				second = key[0]
+				counts = {}
+			found = counts.setdefault(key, [0] * len(self.queries))
+			found[index] += 1
+			if found[index] > max(found[:index] + found[index + 1:]):
+				yield line
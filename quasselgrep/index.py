@@ -0,0 +1,158 @@
+"""Full-text index of backlog messages for SQLite databases
+
+The index is an FTS5 table using the trigram tokenizer, kept in a separate
+database file next to Quassel's own so that Quassel's database is only ever
+read. Rows are keyed by backlog.messageid, so a search can find matching
+messages in the index and join back to the backlog for everything else.
+The trigram tokenizer answers LIKE patterns directly, with the same
+(ASCII case-insensitive) semantics as SQLite's LIKE on the backlog.
+
+The index records the highest messageid it contains, so it can be brought
+up to date by indexing only newer messages (see sync). Messages newer than
+that are still found by searches, by falling back to LIKE for them alone."""
+
+import os
+import sqlite3
+from threading import Thread, Event
+
+from .db import Db, sqlite_uri
+
+VERSION = 2
+BATCH_SIZE = 10000
+
+# Replaces the LIKE on backlog.message in Query when the index is in use.
+TEXT_CLAUSE = ("(backlog.messageid IN (SELECT rowid FROM fts.message_fts WHERE message_fts.message LIKE %(param)s)"
+               " OR (backlog.messageid > (SELECT value FROM fts.indexinfo WHERE key = 'last_messageid')"
+               " AND backlog.message LIKE %(param)s))")
+
+SCHEMA = [
+	"CREATE VIRTUAL TABLE fts.message_fts USING fts5(message, bufferid UNINDEXED, tokenize='trigram')",
+	"CREATE TABLE fts.indexed_buffer (bufferid INTEGER PRIMARY KEY)",
+	"CREATE TABLE fts.indexinfo (key TEXT PRIMARY KEY, value)",
+	"INSERT INTO fts.indexinfo VALUES ('version', %d)" % (VERSION),
+	"INSERT INTO fts.indexinfo VALUES ('last_messageid', 0)",
+]
+
+def attach(connection, path, writable=False):
+	"""Attach the index at path to connection as the schema "fts"
+
+	Unless writable is set the index is attached read-only and must exist."""
+	if not writable and not os.path.exists(path):
+		raise ValueError('Full-text index %s does not exist; create it with --build-index' % (path))
+
+	mode = 'rwc' if writable else 'ro'
+	connection.execute('ATTACH DATABASE ? AS fts', (sqlite_uri(path, mode),))
+
+	if not writable and get_info(connection, 'version') != VERSION:
+		raise ValueError('Full-text index %s is out of date; rebuild it with --build-index' % (path))
+
+def get_info(connection, key):
+	"""Return the value stored under key in the index, or None"""
+	try:
+		row = connection.execute('SELECT value FROM fts.indexinfo WHERE key = ?', (key,)).fetchone()
+	except sqlite3.OperationalError:
+		# No indexinfo table: a new or an old-style index
+		return None
+	return row[0] if row else None
+
+def create(connection):
+	"""Create an empty index, replacing any existing one"""
+	cursor = connection.cursor()
+	cursor.execute('DROP TABLE IF EXISTS fts.message_fts')
+	cursor.execute('DROP TABLE IF EXISTS fts.indexed_buffer')
+	cursor.execute('DROP TABLE IF EXISTS fts.indexinfo')
+	for statement in SCHEMA:
+		cursor.execute(statement)
+	connection.commit()
+
+def purge_deleted_buffers(connection):
+	"""Remove messages of buffers Quassel has deleted from the index
+
+	Returns the number of buffers purged."""
+	cursor = connection.cursor()
+	cursor.execute('SELECT bufferid FROM fts.indexed_buffer WHERE bufferid NOT IN (SELECT bufferid FROM main.buffer)')
+	deleted = [row[0] for row in cursor.fetchall()]
+
+	for bufferid in deleted:
+		cursor.execute('DELETE FROM fts.message_fts WHERE bufferid = ?', (bufferid,))
+		cursor.execute('DELETE FROM fts.indexed_buffer WHERE bufferid = ?', (bufferid,))
+		connection.commit()
+
+	return len(deleted)
+
+def sync(connection, path, batch_size=BATCH_SIZE, verbose=True):
+	"""Bring the index at path up to date with the backlog in connection
+
+	Only messages newer than the last one indexed are read, batch_size at a
+	time; each batch is committed together with the new watermark, so an
+	interrupted sync carries on where it stopped. The index is created if it
+	does not exist (or rebuilt if it is from an older version.)
+	Returns the number of messages indexed."""
+	attach(connection, path, writable=True)
+	try:
+		if get_info(connection, 'version') != VERSION:
+			create(connection)
+
+		purged = purge_deleted_buffers(connection)
+		if purged and verbose:
+			print("Removed %d deleted buffers from the index." % (purged))
+
+		cursor = connection.cursor()
+		count = 0
+		last_id = get_info(connection, 'last_messageid')
+		while True:
+			cursor.execute('SELECT messageid, message, bufferid FROM main.backlog WHERE messageid > ? ORDER BY messageid LIMIT ?',
+			               (last_id, batch_size))
+			rows = cursor.fetchall()
+			if not rows:
+				break
+
+			last_id = rows[-1][0]
+			cursor.executemany('INSERT INTO fts.message_fts (rowid, message, bufferid) VALUES (?, ?, ?)', rows)
+			cursor.executemany('INSERT OR IGNORE INTO fts.indexed_buffer VALUES (?)', set((row[2],) for row in rows))
+			cursor.execute("UPDATE fts.indexinfo SET value = ? WHERE key = 'last_messageid'", (last_id,))
+			connection.commit()
+
+			count += len(rows)
+			if verbose:
+				print("%d messages indexed..." % (count))
+	finally:
+		connection.rollback()
+		connection.execute('DETACH DATABASE fts')
+
+	return count
+
+def build(connection, path, batch_size=BATCH_SIZE):
+	"""(Re)build the index at path from scratch"""
+	attach(connection, path, writable=True)
+	try:
+		create(connection)
+	finally:
+		connection.execute('DETACH DATABASE fts')
+	return sync(connection, path, batch_size)
+
+class SyncThread(Thread):
+	"""Keeps the index up to date in the background, for server mode"""
+	def __init__(self, options, interval):
+		Thread.__init__(self)
+		self.daemon = True
+		self.options = options
+		self.interval = interval
+		self.stopped = Event()
+
+	def run(self):
+		while True:
+			db = Db()
+			try:
+				db.connect(self.options)
+				sync(db.connection, self.options.index_file, verbose=False)
+			except Exception as e:
+				print("Error updating full-text index: %s" % (e))
+			finally:
+				db.close()
+
+			if self.stopped.wait(self.interval):
+				break
+
+	def stop(self):
+		self.stopped.set()
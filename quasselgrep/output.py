@@ -1,3 +1,8 @@
+import csv
+import io
+import json
+from datetime import datetime
+
 from .msgtypes import *
 
 BUF_COL_WIDTH = 16
@@ -14,6 +19,85 @@ def format(datetime_format, time, msg_type, message, sender, buffer):
 	except KeyError:
 		return formatted + ' <Unknown event: %s, %s, %s>' % (msg_type, message, sender)
 
+class Formatter(object):
+	"""Formats the results of one search like format(), reusing what it can from line to line
+
+	The parser for each message type and the column for each buffer are
+	looked up once, and as results come in order of time, each timestamp is
+	kept for the lines after it in the same second."""
+	def __init__(self, datetime_format):
+		self.datetime_format = datetime_format
+		# Lines can only share a timestamp if it doesn't show fractions of a second
+		self.whole_seconds = '%f' not in datetime_format
+		self.second = None
+		self.stamp = None
+		self.columns = {None : '', '' : ''}
+		self.parsers = parser_for_msgtype
+
+	def timestamp(self, time):
+		"""Return the timestamp of a line at time, a datetime"""
+		second = time.replace(microsecond=0) if self.whole_seconds else time
+		if second != self.second:
+			self.second = second
+			self.stamp = '[%s] ' % time.strftime(self.datetime_format)
+		return self.stamp
+
+	def epoch_timestamp(self, seconds):
+		"""Return the timestamp of a line at a whole number of seconds since the epoch, as SQLite stores it"""
+		if seconds != self.second:
+			self.second = seconds
+			self.stamp = '[%s] ' % datetime.fromtimestamp(seconds).strftime(self.datetime_format)
+		return self.stamp
+
+	def column(self, buffer):
+		"""Return the buffer column, padded to BUF_COL_WIDTH"""
+		column = '(%s)' % (buffer)
+		column += ' ' * max(0, (BUF_COL_WIDTH - len(column)))
+		self.columns[buffer] = column
+		return column
+
+	def line(self, stamp, msg_type, message, sender, buffer):
+		"""Return a formatted line, given its timestamp from timestamp() or epoch_timestamp()"""
+		try:
+			column = self.columns[buffer]
+		except KeyError:
+			column = self.column(buffer)
+
+		parser = self.parsers.get(msg_type)
+		if parser is None:
+			return column + stamp + ' <Unknown event: %s, %s, %s>' % (msg_type, message, sender)
+		return column + stamp + parser(message, sender)
+
+# Fields of each result in --format jsonl, csv or tsv; ctxt_for is added with context
+FIELDS = ['messageid', 'time', 'type', 'nick', 'mask', 'buffer', 'network', 'message']
+
+class RecordFormatter(object):
+	"""Formats results as records of their fields, for other programs to read, instead of as text
+
+	Times are seconds since the epoch. With context, each record also has
+	ctxt_for, the messageid of the result it is context for."""
+	def __init__(self, kind, context=False):
+		self.fields = FIELDS + (['ctxt_for'] if context else [])
+		if kind == 'jsonl':
+			self.record = self.json_record
+			self.header = None
+		else:
+			self.buffer = io.StringIO()
+			self.writer = csv.writer(self.buffer, delimiter=',' if kind == 'csv' else '\t', lineterminator='')
+			self.record = self.csv_record
+			self.header = self.csv_record(self.fields)
+
+	def json_record(self, values):
+		return json.dumps(dict(zip(self.fields, values)), ensure_ascii=False)
+
+	def csv_record(self, values):
+		# Quoted fields may contain newlines, so each record is written out separately
+		self.writer.writerow(values)
+		record = self.buffer.getvalue()
+		self.buffer.seek(0)
+		self.buffer.truncate()
+		return record
+
 def msg_parser(message, sender):
 	return '<%s> %s' % (sender, message)
 
@@ -0,0 +1,117 @@
+"""Running a search as several queries at once, over slices of the backlog
+
+The backlog is split into ranges of message IDs, each searched on its own
+database connection in its own thread, and the results of the slices, each
+in order of time, are merged back into one stream in the same order as a
+single query would give. This lets PostgreSQL use more than one core for a
+large search, and several SQLite readers share the work of reading the
+backlog from disk.
+
+With a time range, the slices are cut at the first message ID after evenly
+spaced times in the range (found as for --id-range), so they are of similar
+size if messages were logged in time order. The first and last slices are
+open-ended, and the time conditions still apply, so no messages are missed
+even if they weren't."""
+
+import heapq
+from collections import deque
+from copy import copy
+from itertools import islice, chain
+
+from .db import Db
+from .pipeline import Stage
+from .timeindex import Checkpoints, id_bounds
+from .dimensions import cache_path
+
+def boundaries(query, count):
+	"""Return the message IDs to split the search into count slices at, with None for no limit"""
+	if query.timerange:
+		checkpoints = query.checkpoints or Checkpoints.load(cache_path(query.options, 'checkpoints'))
+		start, end = query.timerange
+		step = (end - start) / count
+		inner = [checkpoints.first_id(query, start + step * i) for i in range(1, count)]
+		checkpoints.save()
+	else:
+		cursor = query.cursor.connection.cursor()
+		low, high = id_bounds(cursor)
+		cursor.close()
+		step = float(high - low + 1) / count if high else 0
+		inner = [low + int(step * i) for i in range(1, count)]
+
+	# If messages weren't logged in time order, the checkpoints may be too, so sort them
+	# to keep the slices from overlapping, and keep within the range found by --id-range
+	first, last = getattr(query, 'minid', None), getattr(query, 'maxid', None)
+	inner = [bound for bound in sorted(set(inner))
+	         if (first is None or bound > first) and (last is None or bound < last)]
+	return [first] + inner + [last]
+
+def slices(query, count):
+	"""Return copies of query, each searching one slice of the backlog"""
+	bounds = boundaries(query, count)
+	result = []
+	for low, high in zip(bounds, bounds[1:]):
+		if low is not None and high is not None and low >= high:
+			continue
+		part = copy(query)
+		part.minid = low
+		part.maxid = high
+		result.append(part)
+	return result
+
+def connect(query):
+	"""Open a connection for a slice, set up like the query's own"""
+	db = Db()
+	cursor = db.connect(query.options)
+	if query.options.use_index:
+		from . import index
+		index.attach(db.connection, query.options.index_file)
+	if query.options.timeout and query.options.db_type == 'postgres':
+		plain = db.connection.cursor()
+		plain.execute('SET statement_timeout = %d' % (query.options.timeout * 1000))
+		plain.close()
+	return db, cursor
+
+def fetch(query, part, cursor):
+	"""Iterable returning batches of the results of one slice, run in the slice's thread"""
+	sql, params = part.statement()
+	cursor.execute(sql, params)
+	for batch in query.fetch(cursor):
+		yield batch
+
+def run(query, count):
+	"""Iterable returning the results of query in batches, searching count slices at once"""
+	parts = slices(query, count)
+	dbs = []
+	stages = []
+	try:
+		for part in parts:
+			db, cursor = connect(query)
+			dbs.append(db)
+			# So that cancelling the query stops every slice
+			query.connections.append(db.connection)
+			stages.append(Stage(fetch(query, part, cursor)))
+		for stage in stages:
+			stage.start()
+
+		rows = heapq.merge(*[chain.from_iterable(stage) for stage in stages], key=lambda row: (row[1], row[0]))
+		if query.page_size:
+			# Each slice found its first page_size results
+			rows = islice(rows, query.page_size)
+		elif query.limit:
+			# Each slice found its last limit results
+			rows = iter(deque(rows, query.limit))
+
+		while True:
+			batch = list(islice(rows, query.options.batch_size))
+			if not batch:
+				return
+			yield batch
+	finally:
+		for stage in stages:
+			stage.stop()
+		for stage in stages:
+			if stage.is_alive():
+				stage.join()
+		for db in dbs:
+			query.connections.remove(db.connection)
+			db.close()
@@ -0,0 +1,78 @@
+"""Indexes which speed up searches of a PostgreSQL backlog
+
+Quassel only indexes the backlog by buffer, so on its own every text or time
+search is a sequential scan. This module knows about the extra indexes
+quasselgrep can make use of, finds out which of them exist and can create
+the missing ones (see --setup-indexes.)"""
+
+import re
+
+class Index(object):
+	"""An index on the backlog table which quasselgrep knows how to use"""
+	def __init__(self, name, kind, definition, pattern, extension=None):
+		self.name = name
+		self.kind = kind
+		self.definition = definition
+		self.extension = extension
+		# Recognises an equivalent index in pg_indexes.indexdef, whatever it is called
+		self.pattern = re.compile(pattern)
+
+INDEXES = [
+	Index('backlog_time', 'time',
+	      'ON backlog (time)',
+	      r'USING btree \("?time"?\)'),
+	Index('backlog_message_trgm', 'trigram',
+	      'ON backlog USING gin (message gin_trgm_ops)',
+	      r'USING gin \(message gin_trgm_ops\)',
+	      extension='pg_trgm'),
+	Index('backlog_message_tsvector', 'tsvector',
+	      "ON backlog USING gin (to_tsvector('simple', message))",
+	      r"USING gin \(to_tsvector\('simple'::regconfig, message\)\)"),
+]
+
+# Text clause for --fulltext; must match the tsvector index expression exactly for it to be used.
+FULLTEXT_CLAUSE = "to_tsvector('simple', backlog.message) @@ plainto_tsquery('simple', %(param)s)"
+
+def available(connection):
+	"""Return the set of kinds of index which exist on the backlog table"""
+	cursor = connection.cursor()
+	cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = 'backlog'")
+	definitions = [row[0] for row in cursor.fetchall()]
+	cursor.close()
+
+	return set(index.kind for index in INDEXES
+	           if any(index.pattern.search(definition) for definition in definitions))
+
+def setup(connection):
+	"""Create any missing indexes
+
+	connection must be in autocommit mode, since indexes are created
+	CONCURRENTLY so as not to lock out Quassel while they are built."""
+	existing = available(connection)
+	cursor = connection.cursor()
+
+	for index in INDEXES:
+		if index.kind in existing:
+			print("Index for %s search already exists." % (index.kind))
+			continue
+
+		if index.extension:
+			try:
+				cursor.execute('CREATE EXTENSION IF NOT EXISTS %s' % (index.extension))
+			except Exception as e:
+				print("Error: Could not create extension %s needed for index %s: %s" % (index.extension, index.name, e))
+				continue
+
+		print("Creating index %s; this may take a long time..." % (index.name))
+		try:
+			cursor.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s %s' % (index.name, index.definition))
+		except Exception as e:
+			print("Error creating index %s: %s" % (index.name, e))
+			# A failed concurrent build leaves an invalid index behind
+			cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % (index.name))
+			continue
+
+		if index.kind in available(connection):
+			print("Created index %s." % (index.name))
+		else:
+			print("Error: An unrelated index named %s already exists." % (index.name))
@@ -0,0 +1,93 @@
+"""Fetching, formatting and writing results concurrently
+
+Each stage runs in its own thread and hands its output to the next through a
+bounded queue, so that waiting for the database, formatting rows and writing
+them out overlap instead of adding up, while only a few batches of results
+are held in memory at once. The last stage, writing, is left to whatever
+iterates over the output of pipeline(); it gets whole batches so that it can
+write each with a single call."""
+
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+
+QUEUE_DEPTH = 4
+
+class End(object):
+	"""Marks the end of a stage's output, and carries any exception it raised"""
+	def __init__(self, exception=None):
+		self.exception = exception
+
+class Stage(Thread):
+	"""Applies function to each item of source, putting the results in a bounded queue"""
+	def __init__(self, source, function=None, depth=QUEUE_DEPTH):
+		Thread.__init__(self)
+		self.daemon = True
+		self.source = source
+		self.function = function
+		self.queue = Queue(depth)
+		self.stopped = Event()
+
+	def run(self):
+		try:
+			for item in self.source:
+				if self.function:
+					item = self.function(item)
+				if not self.put(item):
+					return
+		except Exception as e:
+			self.put(End(e))
+		else:
+			self.put(End())
+
+	def put(self, item):
+		"""Wait for room in the queue, unless the stage is stopped"""
+		while not self.stopped.is_set():
+			try:
+				self.queue.put(item, timeout=0.1)
+				return True
+			except Full:
+				pass
+		return False
+
+	def stop(self):
+		self.stopped.set()
+
+	def __iter__(self):
+		"""Iterate over the stage's output, until it ends or is stopped"""
+		while True:
+			try:
+				item = self.queue.get(timeout=0.1)
+			except Empty:
+				if self.stopped.is_set():
+					return
+				continue
+			if isinstance(item, End):
+				if item.exception:
+					raise item.exception
+				return
+			yield item
+
+def pipeline(batches, format_batch, cancel=None, depth=QUEUE_DEPTH):
+	"""Yield lists of formatted lines, fetching and formatting batches in other threads
+
+	batches is an iterable of lists of rows, and format_batch turns one of those
+	into a list of lines. If the caller stops early, cancel is called to stop
+	whatever the threads are waiting for."""
+	fetcher = Stage(batches, depth=depth)
+	formatter = Stage(fetcher, format_batch, depth=depth)
+	fetcher.start()
+	formatter.start()
+
+	finished = False
+	try:
+		for lines in formatter:
+			yield lines
+		finished = True
+	finally:
+		fetcher.stop()
+		formatter.stop()
+		if not finished and cancel:
+			cancel()
+		# Wait until the threads are no longer using the database
+		fetcher.join()
+		formatter.join()
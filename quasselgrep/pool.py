@@ -0,0 +1,74 @@
+"""A pool of database connections shared by the requests to a server
+
+Opening a connection means a PostgreSQL handshake, or opening the SQLite
+file and reading its schemaversion, which can take longer than a small
+search. The server keeps connections open between requests instead. Each
+is checked before it is handed out, and thrown away if it fails the check or
+a query on it goes wrong."""
+
+from threading import Condition
+
+from .db import Db
+
+class Pool(object):
+	"""Hands out at most maximum connections at once, keeping minimum open from the start"""
+	def __init__(self, options, minimum=1, maximum=8):
+		self.options = options
+		self.maximum = maximum
+		self.idle = []
+		self.size = 0
+		self.condition = Condition()
+
+		for i in range(minimum):
+			self.idle.append(self.open())
+			self.size += 1
+
+	def open(self):
+		db = Db()
+		db.connect(self.options)
+		return db
+
+	def get(self):
+		"""Return a working connection, waiting for one if the maximum are in use"""
+		with self.condition:
+			while not self.idle and self.size >= self.maximum:
+				self.condition.wait()
+			db = self.idle.pop() if self.idle else None
+			if db is None:
+				self.size += 1
+
+		if db is not None:
+			try:
+				db.check()
+				return db
+			except Exception:
+				db.close()
+
+		try:
+			return self.open()
+		except Exception:
+			self.discard()
+			raise
+
+	def put(self, db, broken=False):
+		"""Return a connection to the pool, closing it if it is broken"""
+		if not broken:
+			try:
+				db.reset()
+			except Exception:
+				broken = True
+
+		if broken:
+			db.close()
+			self.discard()
+			return
+
+		with self.condition:
+			self.idle.append(db)
+			self.condition.notify()
+
+	def discard(self):
+		"""Make room for another connection in place of one which was closed"""
+		with self.condition:
+			self.size -= 1
+			self.condition.notify()
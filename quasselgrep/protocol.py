@@ -0,0 +1,163 @@
+"""How a server sends messages and results to its clients
+
+Originally everything was sent as lines of text, which clients copy to their
+output until the server closes the connection. Newer clients ask for
+version 2 of the protocol by sending PROTO=2 with their options (old servers
+ignore it), and COMPRESS=zlib if they want the results compressed. A server
+which understands replies with a line saying what it will do, like
+"PROTO=2 COMPRESS=zlib", and everything after that is sent as frames: a
+4-byte length, a 1-byte kind, and that many bytes of payload. Results are
+compressed as one zlib stream, flushed at the end of each frame, so each
+frame can be decompressed as soon as it arrives.
+
+With version 2, a client may also send SESSION=1 to run more than one search
+on the same connection, and only log in once. After the END frame of each
+search, the server reads the next one, sent the same way as the first
+(options, then the search), until the client closes the connection. Servers
+which allow this say SESSION in their reply; clients only send the next
+search once they have seen it.
+
+Clients which don't ask, or servers which don't answer, use the old protocol."""
+
+import codecs
+import zlib
+from struct import Struct
+
+VERSION = 2
+
+header = Struct('!IB')
+
+# Kinds of frame
+MESSAGE = ord('M')  # A line of text for the user, like how long the queue is
+RESULTS = ord('R')  # Lines of results
+ERROR = ord('E')  # The search failed; the payload says why
+TOKEN = ord('T')  # Where to resume the search after the results so far (see --resume)
+END = ord('Z')  # No more frames
+
+class LineEncoder(object):
+	"""The original protocol, for old clients"""
+	greeting = b''
+	session = False
+
+	def message(self, text):
+		return (text + '\n').encode('utf-8')
+
+	def results(self, lines):
+		return ('\n'.join(lines) + '\n').encode('utf-8')
+
+	def error(self, text):
+		return self.message('Error: %s' % (text))
+
+	def token(self, token):
+		return b''
+
+	def end(self):
+		return b''
+
+class FrameEncoder(object):
+	"""Version 2 of the protocol, optionally compressing results, and running more than one search"""
+	def __init__(self, compress=False, session=False):
+		self.compressor = zlib.compressobj() if compress else None
+		self.session = session
+		greeting = ['PROTO=%d' % (VERSION)]
+		if compress:
+			greeting.append('COMPRESS=zlib')
+		if session:
+			greeting.append('SESSION')
+		self.greeting = (' '.join(greeting) + '\n').encode('ascii')
+
+	def frame(self, kind, payload):
+		return header.pack(len(payload), kind) + payload
+
+	def message(self, text):
+		return self.frame(MESSAGE, text.encode('utf-8'))
+
+	def results(self, lines):
+		data = ('\n'.join(lines) + '\n').encode('utf-8')
+		if self.compressor:
+			data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		return self.frame(RESULTS, data)
+
+	def error(self, text):
+		return self.frame(ERROR, text.encode('utf-8'))
+
+	def token(self, token):
+		if not token:
+			return b''
+		return self.frame(TOKEN, token.encode('ascii'))
+
+	def end(self):
+		return self.frame(END, b'')
+
+def request(compress, session=False):
+	"""Return the option lines a client sends to ask for the newest protocol"""
+	lines = ['PROTO=%d' % (VERSION)]
+	if compress:
+		lines.append('COMPRESS=zlib')
+	if session:
+		lines.append('SESSION=1')
+	return lines
+
+def negotiate(option_list):
+	"""Return an encoder for the protocol asked for in the option lines sent by a client"""
+	if 'PROTO=%d' % (VERSION) not in option_list:
+		return LineEncoder()
+	return FrameEncoder('COMPRESS=zlib' in option_list, 'SESSION=1' in option_list)
+
+class Receiver(object):
+	"""Reads what a server sends from the file-like reader, starting with its reply to the first search"""
+	def __init__(self, reader):
+		self.reader = reader
+		self.greeting = reader.readline().decode('utf-8', 'replace')
+		self.framed = self.greeting.startswith('PROTO=')
+		words = self.greeting.split()
+		self.decompressor = zlib.decompressobj() if 'COMPRESS=zlib' in words else None
+		self.session = 'SESSION' in words
+		# Where to resume the current search, if the connection drops
+		self.token = None
+
+	def copy(self, output, messages=None):
+		"""Copy the reply to one search to output, as text, returning False if it was an error
+
+		Messages and errors go to messages instead, if given. The old protocol
+		doesn't tell them apart from results."""
+		if self.framed:
+			return self.copy_frames(output, messages or output)
+
+		# An old server, sending lines until it closes the connection
+		output.write(self.greeting)
+		# Characters can be split between reads
+		decoder = codecs.getincrementaldecoder('utf-8')('replace')
+		while True:
+			data = self.reader.read1(65536)
+			if not data:
+				break
+			output.write(decoder.decode(data))
+		output.write(decoder.decode(b'', final=True))
+		return True
+
+	def copy_frames(self, output, messages):
+		succeeded = True
+		self.token = None
+		while True:
+			data = self.reader.read(header.size)
+			if len(data) < header.size:
+				raise EOFError('The server closed the connection before the end of the results')
+			length, kind = header.unpack(data)
+			payload = self.reader.read(length)
+			if len(payload) < length:
+				raise EOFError('The server closed the connection before the end of the results')
+
+			if kind == END:
+				return succeeded
+			elif kind == RESULTS:
+				if self.decompressor:
+					payload = self.decompressor.decompress(payload)
+				output.write(payload.decode('utf-8'))
+			elif kind == TOKEN:
+				self.token = payload.decode('ascii')
+			elif kind == ERROR:
+				succeeded = False
+				messages.write('Error: %s\n' % (payload.decode('utf-8')))
+			else:
+				messages.write(payload.decode('utf-8') + '\n')
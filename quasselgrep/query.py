@@ -1,12 +1,22 @@
 from . import output
+from . import index
+from . import pgindex
+from . import context
+from . import cost
+from . import pipeline
+from . import parallel
 from .msgtypes import *
 
+from .dimensions import Dimensions, cache_path
+from .timeindex import Checkpoints
+from .rowcache import RowCache, cacheable
+
 from time import time
 from datetime import datetime
-import re
-from threading import Thread
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from itertools import islice, chain
+from threading import Thread, Event
 
-maskre = re.compile('(?P<nick>.*)!(.*)@(.*)')
 MSG_NORMAL = 1
 MSG_ACTION = 4
 
@@ -23,18 +33,79 @@ class TypesParam(Param):
 		self.clause = 'backlog.type IN %s' % (msg_types,)
 
 
+class IdsParam(Param):
+	"""Matches a column against IDs found beforehand, either listed or in a table"""
+	def __init__(self, column, ids=None, table=None):
+		self.names = []
+		if table:
+			self.clause = '%s IN (SELECT id FROM %s)' % (column, table)
+		else:
+			# The IDs come from the database, not from user input, so can be included directly
+			self.clause = '%s IN (%s)' % (column, ', '.join(str(int(id)) for id in ids))
+
+
+# Longer lists of IDs are passed in an array or temporary table rather than in the query text
+MAX_ID_LIST = 1000
+def batches(iterable, size):
+	"""Split an iterable into lists of at most size items"""
+	iterator = iter(iterable)
+	while True:
+		batch = list(islice(iterator, size))
+		if not batch:
+			return
+		yield batch
+
+class Lines(list):
+	"""A batch of formatted results, with the resume token of the last of them"""
+	token = None
+	# Number of results, not counting the header or separators between windows of context
+	rows = 0
+	# What identifies each message across databases, when searching several (see federation.py)
+	keys = None
+
+def make_token(time, messageid):
+	"""Return an opaque token for resuming a search after the row with this time and messageid"""
+	if isinstance(time, datetime):
+		time = time.isoformat()
+	# Without padding, as '=' would get in the way of sending it to a server
+	return urlsafe_b64encode(('%s/%d' % (time, messageid)).encode('ascii')).decode('ascii').rstrip('=')
+
+def parse_token(token, db_type):
+	"""Return the time and messageid a resume token was made from"""
+	try:
+		padded = token + '=' * (-len(token) % 4)
+		time, messageid = urlsafe_b64decode(padded.encode('ascii')).decode('ascii').split('/')
+		if db_type == 'postgres':
+			return (datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f' if '.' in time else '%Y-%m-%dT%H:%M:%S'), int(messageid))
+		return (int(time), int(messageid))
+	except Exception:
+		raise ValueError("Invalid resume token: %s" % (token))
+
 class Query(object):
 	"""Represents a single query to the database"""
-	joins = [
-		"JOIN sender ON sender.senderid = backlog.senderid",
-		"JOIN buffer ON buffer.bufferid = backlog.bufferid",
+	# Needed to find buffers by network and user; names are looked up separately (see dimensions.py)
+	buffer_joins = [
 		"JOIN network ON network.networkid = buffer.networkid",
 		"JOIN quasseluser ON network.userid = quasseluser.userid"
 	]
 
-	def __init__(self, cursor, options, text, timerange=None):
+	def __init__(self, cursor, options, text, timerange=None, dimensions=None, checkpoints=None, result_cache=None):
 		self.cursor = cursor
 		self.options = options
+		self.result_cache = result_cache
+
+		if dimensions is None:
+			dimensions = Dimensions.load(cache_path(options))
+		self.dimensions = dimensions
+		self.rowcount = 0
+
+		# Why the query was cancelled, if it was
+		self.cancelled = None
+		# Function returning whether whoever wanted the results has gone away
+		self.abandoned = None
+		self.finished = Event()
+		# Connections to the database searching slices of the backlog (see parallel.py)
+		self.connections = []
 
 		self.text = text
 		self.user = options.username
@@ -45,21 +116,35 @@ class Query(object):
 		if options.sender:
 			self.sender_pattern = options.sender + '!%'
 
+		if options.fulltext and 'tsvector' not in options.search_indexes:
+			print("Warning: The backlog has no full-text index (see --setup-indexes); searching with LIKE instead.")
+
 		self.timerange = timerange
 		if timerange:
-			if options.db_type == 'postgres':
-				self.fromtime = timerange[0]
-				self.totime = timerange[1]
-			elif options.db_type == 'sqlite':
-				self.fromtime = timerange[0].strftime('%s')
-				self.totime = timerange[1].strftime('%s')
-
-				# Quassel schemaversion >=31 has timestamps in milliseconds.
-				if options.schemaversion >= 31:
-					self.fromtime = int(self.fromtime) * 1000
-					self.totime = int(self.totime) * 1000
+			self.fromtime = self.db_time(timerange[0])
+			self.totime = self.db_time(timerange[1])
+
+		if options.id_range and checkpoints is None:
+			checkpoints = Checkpoints.load(cache_path(options, 'checkpoints'))
+		self.checkpoints = checkpoints
+
+		# The server caches formatted results in memory instead
+		self.row_cache = None
+		if result_cache is None and options.cache_size and cacheable(self):
+			self.row_cache = RowCache(options, int(options.cache_size * 1024 * 1024))
 
 		self.datetime_format = options.datetime_format
+		# Results are formatted as text, or as records of their fields (--format)
+		self.records = options.format != 'text'
+		if options.export:
+			from .export import Exporter
+			self.output = Exporter(options)
+		elif self.records:
+			self.output = output.RecordFormatter(options.format, bool(options.context))
+		else:
+			self.output = output.Formatter(self.datetime_format)
+		# CSV and TSV start with a header, unless merged with other databases' results
+		self.header = getattr(self.output, 'header', None)
 
 		if options.inclusive:
 			self.msg_types = (MSG, NOTICE, ACTION, NICK, MODE, JOIN, PART, QUIT, KICK, TOPIC, INVITE, SPLITJOIN, SPLITQUIT)
@@ -70,9 +155,27 @@ class Query(object):
 			self.limit = int(options.limit)
 		else:
 			self.limit = 0
+		self.page_size = options.page_size or 0
+		# Context is looked up around each result in turn, so isn't split up
+		self.parallel = options.parallel if not options.context else None
+		# Where to resume after the results handed out so far
+		self.token = None
+		# Whether to record keys for merging with the results of other databases
+		self.keyed = False
+
 
 		#TODO Consider changing this to equality for buffer
-		if options.ignorecase:
+		if options.fulltext and 'tsvector' in options.search_indexes:
+			# Full-text search matches words, so wildcards around the search text mean nothing
+			self.text = text.strip('%')
+			textParam = Param('text', pgindex.FULLTEXT_CLAUSE)
+		elif options.use_index:
+			# The trigram index is case-insensitive like SQLite's LIKE, so -I makes no difference
+			textParam = Param('text', index.TEXT_CLAUSE, ['text'])
+		elif options.ignorecase and options.db_type == 'postgres':
+			# Unlike LOWER(...) LIKE LOWER(...), ILIKE can use a trigram index
+			textParam = Param('text', 'backlog.message ILIKE %(param)s')
+		elif options.ignorecase:
 			textParam = Param('text', 'LOWER(backlog.message) LIKE LOWER(%(param)s)')
 		else:
 			textParam = Param('text', 'backlog.message LIKE %(param)s')
@@ -85,23 +188,83 @@ class Query(object):
 				'sender' : Param('sender', '(sender.sender = %(param)s OR sender.sender LIKE %(param)s)', ['sender_pattern']),
 				'fromtime' : Param('fromtime', 'backlog.time > %(param)s'),
 				'totime' : Param('totime', 'backlog.time < %(param)s'),
+				'minid' : Param('minid', 'backlog.messageid >= %(param)s'),
+				'maxid' : Param('maxid', 'backlog.messageid < %(param)s'),
+				# Results come in order of time and then messageid, so carry on after the last one seen
+				'resume_time' : Param('resume_time', 'backlog.time >= %(param)s AND (backlog.time > %(param)s OR backlog.messageid > %(param)s)',
+				                      ['resume_time', 'resume_id']),
 				# SQLite can't handle tuple parameters, and they're not from user
 				# input so just include them directly in the string
 				'msg_types' : TypesParam(self.msg_types),
 			}
 
-	#def get_senders(self, sender):
-	#	"""Find matching user ids"""
+	def resolve_ids(self):
+		"""Find the IDs of the senders and buffers matching the options
+
+		The sender, buffer, network and quasseluser tables are small, so matching them first
+		and then searching the backlog for those IDs lets the database use the indexes on
+		backlog.bufferid and backlog.senderid instead of joining every row of the backlog."""
+		cursor = self.cursor.connection.cursor()
+
+		if self.sender:
+			params = ['sender']
+			query = ['SELECT sender.senderid FROM sender', self.where_clause(params)]
+			cursor.execute('\n'.join(query), [getattr(self, param) for param in params])
+			self.senderids = [row[0] for row in cursor.fetchall()]
+			if not self.senderids:
+				raise ValueError('No nicks matched %s' % (self.sender))
+
+			del self.params['sender']
+			self.params['senderids'] = self.ids_param(cursor, 'senderids', 'backlog.senderid', self.senderids)
+
+		params = self.filter_params(['user', 'network', 'buffer'])
+		if params:
+			names = ', '.join('%s %s' % (param, getattr(self, param)) for param in params)
+			query = ['SELECT buffer.bufferid FROM buffer'] + self.buffer_joins + [self.where_clause(params)]
+			cursor.execute('\n'.join(query), [getattr(self, param) for param in params])
+			self.bufferids = [row[0] for row in cursor.fetchall()]
+			if not self.bufferids:
+				raise ValueError('No buffers matched %s' % (names))
+
+			for param in ['user', 'network', 'buffer']:
+				del self.params[param]
+			self.params['bufferids'] = self.ids_param(cursor, 'bufferids', 'backlog.bufferid', self.bufferids)
+
+	def ids_param(self, cursor, name, column, ids):
+		"""Return a parameter matching column against ids"""
+		# Slices searched in parallel have their own connections, which can't see this one's temporary tables
+		if len(ids) <= MAX_ID_LIST or (self.parallel and self.options.db_type == 'sqlite'):
+			return IdsParam(column, ids)
 
-	#	if not sender:
-	#		return None
+		if self.options.db_type == 'postgres':
+			# psycopg2 passes lists as arrays
+			return Param(name, '%s = ANY(%%(param)s)' % (column))
+
+		table = 'temp.quasselgrep_%s' % (name)
+		cursor.execute('CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY)' % (table))
+		cursor.execute('DELETE FROM %s' % (table))
+		cursor.executemany('INSERT INTO %s VALUES (?)' % (table), [(id,) for id in ids])
+		return IdsParam(column, table=table)
 
-	#	sender_pattern = '%s!%%' % (sender)
-	#	self.cursor.execute('SELECT senderid FROM sender WHERE sender LIKE %s OR sender=%s'.replace('%s',self.options.param_string), (sender_pattern, sender))
-	#	results = self.cursor.fetchall()
-	#	if not results:
-	#		raise ValueError('No nicks matched %s' % sender)
-	#	return tuple([result[0] for result in results])
+	def db_time(self, when):
+		"""Convert a datetime to how backlog.time is stored in the database"""
+		if self.options.db_type == 'postgres':
+			return when
+
+		seconds = int(when.strftime('%s'))
+		# Quassel schemaversion >=31 has timestamps in milliseconds.
+		if self.options.schemaversion >= 31:
+			return seconds * 1000
+		return seconds
+
+	def resolve_id_range(self):
+		"""Find the range of message IDs logged in the time range
+
+		Searching this range of the primary key is quick even without an index on
+		backlog.time. The time conditions are kept in case times are out of order."""
+		self.minid = self.checkpoints.first_id(self, self.timerange[0])
+		self.maxid = self.checkpoints.first_id(self, self.timerange[1])
+		self.checkpoints.save()
 
 	def filter_params(self, params):
 		"""return only those params which have been set"""
@@ -124,31 +287,18 @@ class Query(object):
 
 		return 'WHERE ' + ' AND '.join(ands)
 
-	def contextbits(self):
-		if self.options.context:
-			ctxt = self.options.context
-			lags = ['       LAG(backlog.messageid, %d) OVER ctxt_window AS ctxt_id_%d,' % (i, i) for i in range(1, ctxt+1)]
-			leads = ['       LEAD(backlog.messageid, %d) OVER ctxt_window AS ctxt_id_%d,' % (i, ctxt+i) for i in range(1, ctxt+1)]
-			leads[-1] = leads[-1][:-1]
-			return lags + leads
-		else:
-			return ''
-
 	def columns(self):
 		columns = []
 		if self.options.db_type == 'postgres':
 			columns.append('backlog.time::timestamp(6)')
 		elif self.options.db_type == 'sqlite':
-			# Quassel schemaversion >=31 has timestamps in milliseconds.
-			if self.options.schemaversion >= 31:
-				columns.append("backlog.time / 1000 AS time")
-			else:
-				columns.append("backlog.time AS time")
-		columns += ["backlog.type", "backlog.message", "sender.sender", "buffer.buffername", "network.networkname"]
+			# As stored, so results can be resumed from their exact time (see format_batch)
+			columns.append("backlog.time AS time")
+		columns += ["backlog.type", "backlog.message", "backlog.senderid", "backlog.bufferid"]
 
 		return columns
 
-	def basequery(self, only_ids=False, context=False):
+	def basequery(self, only_ids=False):
 		"""Common start to queries
 
 		If only_ids is specified, only request IDs, not full records."""
@@ -159,11 +309,7 @@ class Query(object):
 		if not only_ids:
 			query[0] = query[0] + ',\n       '.join(columns)
 
-		if context:
-			query[-1] += ','
-			query += self.contextbits()
-
-		query += ["FROM backlog"] + self.joins
+		query.append("FROM backlog")
 
 		return query
 
@@ -173,69 +319,73 @@ class Query(object):
 		query = self.basequery(only_ids)
 		query.append(self.where_clause(params))
 
-		if self.limit:
+		# Ordered by messageid too so that results can be resumed after any of them
+		if self.page_size:
+			query.append("ORDER BY backlog.time, backlog.messageid")
+			query.append("LIMIT %s" % (self.options.param_string))
+			params.append("page_size")
+		elif self.limit:
 			query.insert(0,"SELECT * FROM (")
-			query.append("ORDER BY backlog.time DESC")
+			query.append("ORDER BY backlog.time DESC, backlog.messageid DESC")
 			query.append("LIMIT %s) AS query" % (self.options.param_string))
-			query.append("ORDER BY query.time")
+			query.append("ORDER BY query.time, query.messageid")
 			params.append("limit")
 		else:
-			query.append("ORDER BY backlog.time")
+			query.append("ORDER BY backlog.time, backlog.messageid")
 		#print '\n'.join(query)
 		return ('\n'.join(query), [getattr(self,param) for param in params])
 
-	def allpossible_query(self):
-		"""Get all possible IDs - ignore text and sender"""
-		params = self.filter_params(["user", "network", "buffer", "fromtime", "totime"])
-		query = self.basequery(only_ids=True)
-		query.append(self.where_clause(params))
-
-		query.append("ORDER BY backlog.time")
-
-		return ('\n'.join(query), [getattr(self,param) for param in params])
-
 	def context_query(self):
-		params = self.filter_params(["user", "network", "buffer", "fromtime", "totime"])
-		ctxt_query = self.basequery(only_ids=True, context=True)
-		central_id_query, all_params = self.search_query(only_ids=True)
-		central_id_query = central_id_query.replace('\n', '\n    ')
-
-		# First set up two WITH queries. The first is getting the IDs of the results from the actual search;
-		# the second running a looser query (it ignores the message search part for example), getting not just
-		# matching IDs but IDs of the next/previous N rows that also match the loose query in the same buffer.
-		context_extra_queries = [
-			'WITH central_ids AS (',
-			'    ' + central_id_query + '),',
-			'context_ids AS (',
-			'    ' + '\n    '.join(ctxt_query),
-			'    ' + self.where_clause(params),
-			'    WINDOW ctxt_window AS (PARTITION BY backlog.bufferid ORDER BY backlog.time, backlog.messageid ASC)',
-			'    ORDER BY time'
-			')']
-
-		# Extract the IDs and annotate the rows with ctxt_for, the ID of the row which 'caused' that this one to match.
-		context_unions = [
-			['    UNION',
-			 '    SELECT ctxt_id_%d AS ctxt_for, messageid FROM context_ids' % (i),
-			 '    WHERE context_ids.ctxt_id_%d IN (SELECT * FROM central_ids)' % (i)]
-			for i in range(1, self.options.context*2 + 1)
-		]
-
-		columns = ['backlog.messageid'] + self.columns() + ['context.ctxt_for']
-
-		# This is the *actual* query.
-		context_query = [
-			'SELECT ' + ', '.join(columns),
-			'FROM (',
-			'    SELECT messageid AS ctxt_for, messageid FROM context_ids',
-			'    WHERE context_ids.messageid IN (SELECT * FROM central_ids)']
-		context_query += [l for u in context_unions for l in u] + [
-			') context',
-			'JOIN backlog ON context.messageid = backlog.messageid'] + self.joins
-		context_query += ['ORDER BY ctxt_for, time']
-
-		return ('\n'.join(context_extra_queries + context_query), all_params + [getattr(self,param) for param in params])
-
+		"""Get the results of the search together with their context lines
+
+		The first WITH query is the actual search. Then the previous and next N rows in
+		the same buffer are looked up for each result from the (bufferid, messageid) index,
+		so the cost depends on the number of results rather than the size of the backlog.
+		The rows are annotated with ctxt_for, the ID of the row which 'caused' them to match."""
+		central_query, params = self.search_query()
+		central_query = central_query.replace('\n', '\n    ')
+
+		neighbours = ('SELECT neighbour.messageid FROM backlog AS neighbour'
+		              ' WHERE neighbour.bufferid = hits.bufferid AND neighbour.messageid %s hits.messageid'
+		              ' ORDER BY neighbour.messageid %s LIMIT %d')
+		columns = ['backlog.messageid'] + self.columns() + ['hits.messageid AS ctxt_for']
+
+		query = [
+			'WITH hits AS (',
+			'    ' + central_query + ')',
+			'SELECT ' + ',\n       '.join(columns),
+			'FROM hits',
+			'CROSS JOIN LATERAL (',
+			'    (' + neighbours % ('<', 'DESC', self.options.context) + ')',
+			'    UNION ALL',
+			'    SELECT hits.messageid',
+			'    UNION ALL',
+			'    (' + neighbours % ('>', 'ASC', self.options.context) + ')',
+			') AS context',
+			'JOIN backlog ON backlog.messageid = context.messageid',
+			'ORDER BY hits.time, hits.messageid, backlog.messageid']
+
+		return ('\n'.join(query), params)
+
+	def neighbour_query(self, before):
+		"""Get the context lines immediately before or after one message in the same buffer
+
+		Parameters are the bufferid and messageid. These lines are not subject to the
+		other options, which could make the database look through the whole buffer."""
+		query = self.basequery()
+		query.append('WHERE backlog.bufferid = %s AND backlog.messageid %s %s' %
+		             (self.options.param_string, '<' if before else '>', self.options.param_string))
+		query.append('ORDER BY backlog.messageid %s' % ('DESC' if before else 'ASC'))
+		query.append('LIMIT %d' % (self.options.context))
+
+		return '\n'.join(query)
+
+	def statement(self):
+		"""Return the query to run and its parameters"""
+		if self.options.context and self.options.db_type == 'postgres':
+			return self.context_query()
+		# SQLite has no LATERAL joins, so the context of each result is looked up afterwards
+		return self.search_query()
 
 	def run(self):
 		"""Run a database query according to options
@@ -244,31 +394,122 @@ class Query(object):
 		options using the supplied cursor object."""
 
 		start = time()
+		if self.options.resume:
+			self.resume_time, self.resume_id = parse_token(self.options.resume, self.options.db_type)
+
+		if self.result_cache and not self.options.debug:
+			cached = self.result_cache.get(self)
+			if cached is not None:
+				print("Query answered from cache in %.2f seconds" % (time() - start))
+				return self.replay(cached)
+
+		self.resolve_ids()
+		if self.options.id_range and self.timerange:
+			self.resolve_id_range()
+		self.dimensions.refresh(self.cursor.connection)
+
+		query, params = self.statement()
+		if self.options.debug:
+			return self.debug(query, params)
+		self.start_watching()
+		try:
+			if self.options.max_cost:
+				query, params = self.check_cost(query, params)
+			if self.row_cache:
+				path = self.row_cache.path(self, query, params)
+				freshness = self.row_cache.freshness(self)
+				cached = self.row_cache.load(path, freshness)
+				if cached is not None:
+					print("Query answered from cache in %.2f seconds" % (time() - start))
+					return self.formatter(cached)
+			if not self.parallel:
+				self.execute_query(query, params)
+		except:
+			self.finished.set()
+			raise
 
-		# If the user wants context lines we have to use a different query
-		if self.options.context:
-			query, params = self.context_query()
-			if self.options.debug:
-				print("Getting context of IDs with:")
-				print(query)
-				print(params)
-				query = 'EXPLAIN ' + query
-			self.execute_query(query, params)
+		if self.parallel:
+			# Each slice is searched once its thread starts, as its results are needed
+			results = parallel.run(self, self.parallel)
 		else:
-			# Simple case
-			if not self.options.debug:
-				self.execute_query(*self.search_query())
-			else:
-				query, params = self.search_query()
-				print(query)
-				print(params)
-				self.cursor.execute("EXPLAIN " + query, params)
+			print("Query completed in %.2f seconds" % (time() - start))
+			results = self.results()
+		if self.row_cache:
+			results = self.row_cache.save(path, freshness, results)
+		return self.formatter(results)
+
+	def results(self):
+		"""Iterable returning the results of the query that has been run, in batches"""
+		if self.options.context and self.options.db_type == 'sqlite':
+			rows = context.windows(self, self.rows(self.cursor))
+			return batches(context.merge_windows(rows), self.options.batch_size)
+		elif self.options.context:
+			return batches(context.merge_windows(self.rows(self.cursor)), self.options.batch_size)
+		return self.fetch(self.cursor)
+
+	def debug(self, query, params):
+		"""Show the query and how the database would run it, instead of running it"""
+		print(query)
+		print(params)
+		if self.options.context and self.options.db_type == 'sqlite':
+			print("Then for the context of each result:")
+			print(self.neighbour_query(before=True))
+			print(self.neighbour_query(before=False))
+
+		lines = cost.explain(self, query, params)
+		lines.append('Estimated cost: %s (%s)' % cost.estimate(self, query, params))
+		# Returned the same way as the results of a query
+		return (batch for batch in [lines])
+
+	def check_cost(self, query, params):
+		"""Apply options.cost_policy if the query is estimated to cost more than options.max_cost
+
+		Returns the query to run instead, and its parameters."""
+		estimate, reason = cost.estimate(self, query, params)
+		if estimate <= self.options.max_cost:
+			return (query, params)
+
+		message = ('This search would cost about %d, %s, which is more than the maximum of %d' %
+		           (estimate, reason, self.options.max_cost))
+		if self.options.cost_policy == 'warn':
+			print("Warning: %s." % (message))
+		elif self.options.cost_policy == 'limit' and self.page_size:
+			self.page_size = min(self.page_size, cost.LIMIT)
+			print("Warning: %s; showing only the next %d results." % (message, self.page_size))
+			return self.statement()
+		elif self.options.cost_policy == 'limit':
+			if not self.limit or self.limit > cost.LIMIT:
+				self.limit = cost.LIMIT
+			print("Warning: %s; showing only the last %d results." % (message, self.limit))
+			return self.statement()
+		else:
+			raise ValueError('%s. Try narrowing it down by time, buffer or nick.' % (message))
+		return (query, params)
+
+	def fetch(self, cursor):
+		"""Iterable returning the results of the query in lists of at most batch_size rows
 
-		print("Query completed in %.2f seconds" % (time() - start))
-		return self.formatter(self.cursor)
+		Only one batch is held in memory at a time."""
+		cursor.arraysize = self.options.batch_size
+		while True:
+			rows = cursor.fetchmany(self.options.batch_size)
+			if not rows:
+				break
+			yield rows
+
+	def rows(self, cursor):
+		"""Iterable returning the results of the query one row at a time"""
+		return chain.from_iterable(self.fetch(cursor))
 
 	def execute_query(self, query, params=[]):
-		thread = Thread(target=self.cursor.execute, args=(query,params))
+		errors = []
+		def execute():
+			try:
+				self.cursor.execute(query, params)
+			except Exception as e:
+				errors.append(e)
+
+		thread = Thread(target=execute)
 		thread.daemon = True
 		thread.start()
 		try:
@@ -276,50 +517,163 @@ class Query(object):
 				thread.join(1)
 				if not thread.is_alive(): break
 		except KeyboardInterrupt:
-			print("Stopping.")
+			self.cancel('Stopped')
+			thread.join()
 			raise
 
-	def formatter(self, results):
-		"""Iterable returning formatted database rows
-
-		Take an iterable of rows as returned from the database and format them like a line from IRC."""
-		context = self.options.context
-		ctxt_for = None
-		messageid_history = []
-
-		for result in results:
-			# Special handling for output of context
-			if context:
-				messageid = result[0]
-
-				# There may be duplicate rows where the context of one message is also context of another. So if we see
-				# the same msg id, skip it.
-				if messageid in messageid_history:
-					ctxt_for = result[7]
-					continue
-				# When ctxt_for changes we are changing context groups: print a separator. At this point we also clear
-				# the history of ids. It could be that the previous group was from buffer A, we are now printing a
-				# group from buffer B and we will see duplicate rows from buffer A again - but we still want to print
-				# them because there was stuff in the way, so erasing the history is fine.
-				if ctxt_for and ctxt_for != result[7]:
-					messageid_history = []
-					yield '---'
-				messageid_history.append(messageid)
-				ctxt_for = result[7]
+		if errors:
+			self.raise_error(errors[0])
 
-			#Extract data we care about
-			if self.options.db_type == 'postgres':
-				time = result[1]
-			elif self.options.db_type == 'sqlite':
-				time = datetime.fromtimestamp(result[1])
+	def cancel(self, reason='Search cancelled'):
+		"""Stop the query running in the database, from any thread
 
-			type = result[2]
-			message = result[3]
+		Whatever is waiting for the database then gets an error."""
+		if self.cancelled:
+			return
+		self.cancelled = reason
+		for connection in [self.cursor.connection] + list(self.connections):
 			try:
-				sender = maskre.match(result[4]).group('nick')
-			except:
-				sender = result[4]
-			buffer = result[5] if not self.buffer else None
+				if self.options.db_type == 'postgres':
+					connection.cancel()
+				else:
+					connection.interrupt()
+			except Exception:
+				# The connection is closed already
+				pass
+
+	def raise_error(self, error):
+		"""Raise error from the database, or a ValueError saying why if the query was cancelled"""
+		if self.cancelled:
+			raise ValueError(self.cancelled)
+		raise error
+
+	def start_watching(self):
+		"""Cancel the query if it takes longer than options.timeout seconds, or is abandoned"""
+		if self.options.timeout and self.options.db_type == 'postgres':
+			# Also have the database enforce the timeout, should quasselgrep itself get stuck
+			cursor = self.cursor.connection.cursor()
+			cursor.execute('SET statement_timeout = %d' % (self.options.timeout * 1000))
+			cursor.close()
+
+		if self.options.timeout or self.abandoned:
+			thread = Thread(target=self.watch)
+			thread.daemon = True
+			thread.start()
+
+	def watch(self):
+		"""Check on the query every second until it is finished"""
+		deadline = time() + self.options.timeout if self.options.timeout else None
+		while True:
+			interval = 1.0 if deadline is None else min(1.0, max(deadline - time(), 0))
+			if self.finished.wait(interval):
+				return
+			if deadline is not None and time() >= deadline:
+				self.cancel('Search cancelled after %g seconds (see --timeout)' % (self.options.timeout))
+				return
+			if self.abandoned and self.abandoned():
+				self.cancel('The client went away')
+				return
 
-			yield output.format(self.datetime_format, time, type, message, sender, buffer)
+	def formatter(self, results):
+		"""Iterable returning lists of formatted database rows
+
+		Take an iterable of lists of rows as returned from the database and format them like lines from IRC.
+		Unless options.serial is set, fetching and formatting run in their own threads, leaving
+		the caller free to write out each list while the next ones are prepared (see pipeline.py.)"""
+		if self.options.serial:
+			lines = (self.format_batch(rows) for rows in results)
+		else:
+			lines = pipeline.pipeline(results, self.format_batch, self.cancel)
+
+		if self.result_cache:
+			recording = self.result_cache.recording()
 
+		try:
+			for batch in lines:
+				if self.result_cache:
+					recording.add(batch)
+				self.token = getattr(batch, 'token', None) or self.token
+				yield batch
+		except Exception as e:
+			self.raise_error(e)
+		finally:
+			lines.close()
+			self.finished.set()
+
+		if self.result_cache:
+			self.result_cache.put(self, recording)
+		self.dimensions.save()
+
+	def replay(self, batches):
+		"""Iterable returning batches of formatted results from the result cache"""
+		for batch in batches:
+			self.rowcount += batch.rows
+			self.token = getattr(batch, 'token', None) or self.token
+			yield batch
+
+	def format_batch(self, rows):
+		"""Format a list of rows, looking up all of their senders together"""
+		self.dimensions.fetch_senders(self.cursor.connection, self.options.param_string,
+		                              set(row[4] for row in rows if row is not None))
+		if self.options.export:
+			return self.output.batch(self, rows)
+
+		formatter = self.output
+		sender_of = self.dimensions.sender
+		buffer_of = self.dimensions.buffer
+		if self.options.db_type == 'postgres':
+			scale = None
+		else:
+			# Quassel schemaversion >=31 has timestamps in milliseconds.
+			scale = 1000 if self.options.schemaversion >= 31 else 1
+		if not self.records:
+			timestamp = formatter.timestamp if scale is None else formatter.epoch_timestamp
+
+		lines = Lines()
+		if self.keyed:
+			lines.keys = []
+		elif self.header:
+			lines.append(self.header)
+			self.header = None
+		last = None
+		for result in rows:
+			# Windows of context which don't overlap are separated (records have ctxt_for instead)
+			if result is None:
+				if not self.records:
+					lines.append('---')
+				continue
+			self.rowcount += 1
+			lines.rows += 1
+
+			#Extract data we care about
+			time = result[1] if scale is None else result[1] // scale
+			type = result[2]
+			message = result[3]
+			sender, mask = sender_of(result[4])
+			buffer, network = buffer_of(result[5])
+
+			if self.records:
+				if scale is None:
+					epoch = result[1].timestamp()
+				else:
+					epoch = result[1] / scale if scale > 1 else result[1]
+				values = [result[0], epoch, type, sender, mask, buffer, network, message]
+				if self.options.context:
+					values.append(result[context.CTXT_FOR])
+				lines.append(formatter.record(values))
+			else:
+				lines.append(formatter.line(timestamp(time), type, message, sender, buffer if not self.buffer else None))
+			if self.keyed:
+				if scale is not None:
+					time = datetime.fromtimestamp(time)
+				# Only whole seconds, as SQLite databases before schema version 31 have no more
+				lines.keys.append((time.replace(microsecond=0), buffer, sender, type, message))
+			last = result
+
+		if last is not None:
+			lines.token = make_token(last[1], last[0])
+		return lines
+
+	def more(self):
+		"""Return whether a page of results was filled, so there may be more after it"""
+		return bool(self.page_size) and self.rowcount >= self.page_size
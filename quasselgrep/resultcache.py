@@ -0,0 +1,108 @@
+"""Cache of formatted search results for the server
+
+Users tend to repeat the same searches, so the server keeps the results of
+recent ones in memory, up to a budget, and forgets the least recently used
+first. Results stay valid until the cache's TTL runs out, except that if
+new messages have been logged since, results whose time range was still
+open at the time (ending now, or with no time range at all) are thrown away.
+Open ranges given relative to now, like "-1week", are matched by what was
+asked for rather than by their exact start, so within the TTL they may
+include a few messages from just before the start of the range."""
+
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from time import time
+
+# Options which make no difference to the results
+IGNORED_OPTIONS = ['password', 'username', 'timerange', 'keywords', 'serial', 'batch_size', 'stats']
+
+# Rough number of bytes used by each line on top of its text
+LINE_OVERHEAD = 80
+
+class Entry(object):
+	def __init__(self, batches, size, maxid, closed):
+		self.batches = batches
+		self.size = size
+		self.maxid = maxid
+		self.closed = closed
+		self.created = time()
+
+class Recording(object):
+	"""Collects the results of a query as they are sent, until they grow too large to cache"""
+	def __init__(self, limit):
+		self.batches = []
+		self.size = 0
+		self.limit = limit
+
+	def add(self, lines):
+		if self.batches is None:
+			return
+		self.size += sum(len(line) + LINE_OVERHEAD for line in lines)
+		if self.size > self.limit:
+			self.batches = None
+		else:
+			self.batches.append(lines)
+
+class ResultCache(object):
+	"""LRU cache of formatted results, using at most budget bytes, for at most ttl seconds"""
+	def __init__(self, program, budget, ttl):
+		self.valid_options = sorted(set(program.valid_options) - set(IGNORED_OPTIONS))
+		self.budget = budget
+		self.ttl = ttl
+		self.lock = Lock()
+		self.entries = OrderedDict()
+		self.size = 0
+
+	def key(self, query):
+		options = tuple((name, str(getattr(query.options, name, None))) for name in self.valid_options)
+		if query.timerange and query.timerange[1] < datetime.now():
+			# A range in the past always means the same messages
+			timerange = tuple(query.timerange)
+		else:
+			timerange = query.options.timerange
+		return (query.user, query.text, timerange, options)
+
+	def get(self, query):
+		"""Return the cached results of query, or None
+
+		Either way, remembers the highest message ID on query, for put()."""
+		cursor = query.cursor.connection.cursor()
+		cursor.execute('SELECT MAX(messageid) FROM backlog')
+		query.cache_maxid = cursor.fetchone()[0]
+		cursor.close()
+
+		key = self.key(query)
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				return None
+			if time() - entry.created > self.ttl or (entry.maxid != query.cache_maxid and not entry.closed):
+				self.remove(key)
+				return None
+			self.entries.move_to_end(key)
+			return entry.batches
+
+	def recording(self):
+		# One search shouldn't push out everything else
+		return Recording(self.budget // 4)
+
+	def put(self, query, recording):
+		"""Cache the results of query, if they were not too large"""
+		if recording.batches is None:
+			return
+		closed = bool(query.timerange) and query.timerange[1] < datetime.now()
+		entry = Entry(recording.batches, recording.size, query.cache_maxid, closed)
+
+		key = self.key(query)
+		with self.lock:
+			if key in self.entries:
+				self.remove(key)
+			self.entries[key] = entry
+			self.size += entry.size
+			while self.size > self.budget:
+				self.remove(next(iter(self.entries)))
+
+	def remove(self, key):
+		"""Forget an entry (call with lock held)"""
+		self.size -= self.entries.pop(key).size
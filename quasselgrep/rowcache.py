@@ -0,0 +1,143 @@
+"""On-disk cache of the results of searches over time ranges in the past
+
+Messages are only ever logged at the current time, so once a time range has
+ended, searching it will always find the same messages, unless some of
+them are deleted (along with their buffer.) The rows found by such searches
+are saved under ~/.cache/quasselgrep, keyed by the SQL and parameters of the
+search, and used again when the same search is repeated. To catch deletions,
+the number of messages in the range and the highest message ID among them
+are saved too, and checked before the cached rows are used; the range is
+found as for --id-range, so this only involves reading the primary key.
+
+Rows rather than formatted lines are saved, so names and formats are always
+up to date. Context lines may come from after the end of the range, so
+results with context are only used again while no new messages have been
+logged. The least recently used results are removed to keep the cache
+within --cache-size."""
+
+import os
+import pickle
+from datetime import datetime
+from hashlib import sha1
+
+from .dimensions import CACHE_DIR, cache_path
+from .timeindex import Checkpoints
+
+VERSION = 2
+
+def cacheable(query):
+	"""Return whether the results of query can be cached"""
+	return bool(query.timerange) and query.timerange[1] < datetime.now() and not query.options.debug
+
+class RowCache(object):
+	def __init__(self, options, budget):
+		self.options = options
+		self.budget = budget
+		self.directory = os.path.join(CACHE_DIR, 'results')
+
+	def path(self, query, sql, params):
+		"""Return the file for the results of sql with params, run by query"""
+		options = self.options
+		key = [os.path.basename(cache_path(options, 'results')), sql, params]
+		# Long lists of IDs are put in temporary tables, so aren't in the SQL or its parameters
+		for name in ('senderids', 'bufferids'):
+			ids = getattr(query, name, None)
+			if ids is not None:
+				key.append(sorted(ids))
+		if options.context and options.db_type == 'sqlite':
+			# The context is looked up separately
+			key.append(query.neighbour_query(before=True))
+		return os.path.join(self.directory, '%s.pickle' % (sha1(repr(key).encode('utf-8')).hexdigest()))
+
+	def freshness(self, query):
+		"""Return the number of messages in the time range of query, and the highest message ID among them
+
+		With context, the highest message ID of all is included too."""
+		minid, maxid = getattr(query, 'minid', None), getattr(query, 'maxid', None)
+		if minid is None or maxid is None:
+			checkpoints = query.checkpoints or Checkpoints.load(cache_path(self.options, 'checkpoints'))
+			minid = checkpoints.first_id(query, query.timerange[0])
+			maxid = checkpoints.first_id(query, query.timerange[1])
+			checkpoints.save()
+
+		cursor = query.cursor.connection.cursor()
+		cursor.execute('SELECT COUNT(*), MAX(messageid) FROM backlog WHERE messageid >= %s AND messageid < %s' %
+		               (self.options.param_string, self.options.param_string), (minid, maxid))
+		freshness = tuple(cursor.fetchone())
+		if self.options.context:
+			cursor.execute('SELECT MAX(messageid) FROM backlog')
+			freshness += tuple(cursor.fetchone())
+		cursor.close()
+		return freshness
+
+	def load(self, path, freshness):
+		"""Return an iterable over the cached batches of rows at path, or None if there are none"""
+		try:
+			fd = open(path, 'rb')
+			version, cached_freshness = pickle.load(fd)
+		except Exception:
+			return None
+
+		if version != VERSION or cached_freshness != freshness:
+			fd.close()
+			os.remove(path)
+			return None
+
+		# Mark as recently used
+		os.utime(path)
+		return self.read(fd)
+
+	def read(self, fd):
+		with fd:
+			while True:
+				try:
+					yield pickle.load(fd)
+				except EOFError:
+					return
+
+	def save(self, path, freshness, batches):
+		"""Iterable passing on batches, saving them to path if it gets to the end of them"""
+		tmp = '%s.%d.tmp' % (path, os.getpid())
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			fd = open(tmp, 'wb')
+		except OSError:
+			# The cache is only an optimisation
+			for batch in batches:
+				yield batch
+			return
+
+		finished = False
+		try:
+			with fd:
+				pickle.dump((VERSION, freshness), fd, pickle.HIGHEST_PROTOCOL)
+				for batch in batches:
+					pickle.dump(batch, fd, pickle.HIGHEST_PROTOCOL)
+					yield batch
+			os.replace(tmp, path)
+			finished = True
+		finally:
+			if not finished and os.path.exists(tmp):
+				os.remove(tmp)
+		self.trim()
+
+	def trim(self):
+		"""Remove the least recently used results until the cache is within budget"""
+		files = []
+		for name in os.listdir(self.directory):
+			path = os.path.join(self.directory, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			files.append((stat.st_mtime, stat.st_size, path))
+
+		total = sum(size for (mtime, size, path) in files)
+		for (mtime, size, path) in sorted(files):
+			if total <= self.budget:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
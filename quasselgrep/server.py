@@ -1,8 +1,16 @@
+import codecs
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from threading import Lock, Event
 from socketserver import ThreadingTCPServer, TCPServer, BaseRequestHandler
 from shlex import split
 from os import urandom
+from select import select
+from socket import MSG_PEEK
 
 from .util import getdata
+from . import protocol
 
 class AuthException(Exception):
 	pass
@@ -10,6 +18,169 @@ class AuthException(Exception):
 class Object(object):
 	pass
 
+def parse_options(program, option_list):
+	"""Turn the NAME=VALUE lines sent by a client into options and a search string"""
+	#valid_options = [opt.dest for opt in self.server.program.parser.option_list if opt.dest]
+	options = Object()
+	search = ''
+	for opt in program.all_options:
+		setattr(options, opt, None)
+
+	for option in option_list:
+		option = option.split('=')
+		if len(option) != 2:
+			continue
+		if option[0] == 'SEARCH':
+			search = option[1]
+			continue
+		#Sanity/safety check
+		if option[0] not in program.valid_options:
+			continue
+		setattr(options, option[0], option[1])
+
+	return options, search
+
+class Ticket(object):
+	"""A request's place in the Scheduler's queue
+
+	wake is called (with the scheduler's lock held) whenever the request is
+	let through or its place in the queue changes."""
+	def __init__(self, user, wake):
+		self.user = user
+		self.wake = wake
+		self.admitted = False
+
+class Scheduler(object):
+	"""Decides which requests may run a query
+
+	At most max_queries run at once, and at most max_user_queries for any one
+	user. Each user's requests wait in their own queue, and the queues take it in
+	turns, so one user sending many requests doesn't hold up everybody else."""
+	def __init__(self, max_queries, max_user_queries):
+		self.max_queries = max_queries
+		self.max_user_queries = max_user_queries
+		self.lock = Lock()
+		self.queues = OrderedDict()  # user -> waiting tickets; the next user to be served first
+		self.running = {}  # user -> number of queries running
+
+	def submit(self, user, wake):
+		"""Queue a request for user, and return its Ticket"""
+		ticket = Ticket(user, wake)
+		with self.lock:
+			self.queues.setdefault(user, deque()).append(ticket)
+			self.schedule()
+		return ticket
+
+	def finish(self, ticket):
+		"""Give up a ticket's place, whether or not its query has run"""
+		with self.lock:
+			if ticket.admitted:
+				self.running[ticket.user] -= 1
+				if not self.running[ticket.user]:
+					del self.running[ticket.user]
+			else:
+				queue = self.queues[ticket.user]
+				queue.remove(ticket)
+				if not queue:
+					del self.queues[ticket.user]
+			self.schedule()
+
+	def position(self, ticket):
+		"""Return how many requests will be let through before ticket, or None if it has been"""
+		with self.lock:
+			if ticket.admitted:
+				return None
+			# Taking turns, the requests ahead are those in the same place in the queues of the users
+			# served after this one, and those up to and including that place for the users served before
+			place = self.queues[ticket.user].index(ticket)
+			ahead = 0
+			before = True
+			for user, queue in self.queues.items():
+				if user == ticket.user:
+					ahead += place
+					before = False
+				else:
+					ahead += min(len(queue), place + 1 if before else place)
+			return ahead
+
+	def schedule(self):
+		"""Let through as many waiting requests as the limits allow (call with lock held)"""
+		admitted = True
+		while admitted and sum(self.running.values()) < self.max_queries:
+			admitted = False
+			for user, queue in self.queues.items():
+				if self.running.get(user, 0) >= self.max_user_queries:
+					continue
+				ticket = queue.popleft()
+				ticket.admitted = True
+				ticket.wake()
+				self.running[user] = self.running.get(user, 0) + 1
+				if queue:
+					# Go to the back of the line
+					self.queues.move_to_end(user)
+				else:
+					del self.queues[user]
+				admitted = True
+				break
+
+		# Let everyone know where they stand
+		for queue in self.queues.values():
+			for ticket in queue:
+				ticket.wake()
+
+def client_gone(socket):
+	"""Return whether the client has closed its end of socket"""
+	readable = select([socket], [], [], 0)[0]
+	if not readable:
+		return False
+	try:
+		return not socket.recv(1, MSG_PEEK)
+	except OSError:
+		return True
+
+def read_request(reader):
+	"""Read the lines of a request, ending with the search, or return None at the end of input"""
+	option_list = []
+	while True:
+		line = reader.readline()
+		if not line:
+			return None
+		option_list.append(line.decode('utf-8').rstrip('\n'))
+		# The search is always sent last
+		if option_list[-1].startswith('SEARCH='):
+			return option_list
+
+class Session(object):
+	"""What a connection remembers between searches"""
+	def __init__(self, salt, peer):
+		self.salt = salt
+		# The address of the client
+		self.peer = peer
+		# Who has logged in, once they have
+		self.user = None
+
+	def queue_key(self, options):
+		"""Return whose queue a request waits in (see Scheduler)
+
+		Passwords are only checked when a search runs, so until the user has
+		logged in on this connection, a request waits with the others from the
+		same address rather than in the queue of whoever it claims to be."""
+		if self.user is not None and options.username == self.user:
+			return self.user
+		return ('unauthenticated', self.peer)
+
+def queue_message(position):
+	"""Tell a client how long it has to wait"""
+	if position:
+		return 'Waiting for %d searches queued ahead of this one...' % (position)
+	return 'Waiting for another search to finish...'
+
+def more_message(encoder, query):
+	"""Tell a client how to get the next page of results, if there may be one"""
+	if not query.more():
+		return b''
+	return encoder.message('There may be more results; see them with --resume %s' % (query.token))
+
 class QuasselGrepHandler(BaseRequestHandler):
 	def handle(self):
 		socket = self.request
@@ -21,35 +192,56 @@ class QuasselGrepHandler(BaseRequestHandler):
 			socket.close()
 			return
 
-		salt = codecs.encode(urandom(32), 'hex')
-		socket.sendall(b'SALT=%s\n' % (salt))
+		salt = codecs.encode(urandom(32), 'hex').decode('ascii')
+		socket.sendall(('SALT=%s\n' % (salt)).encode('ascii'))
 
-		option_list = []
-		while True:
-			new = getdata(socket)
-			if new[-1] == '':
-				option_list += new[:-1]
-				break
-			option_list += new
-
-		#valid_options = [opt.dest for opt in self.server.program.parser.option_list if opt.dest]
-		options = Object()
-		search = ''
-		for opt in program.all_options:
-			setattr(options, opt, None)
-
-		for option in option_list:
-			option = option.split('=')
-			if len(option) != 2:
-				continue
-			if option[0] == 'SEARCH':
-				search = option[1]
-				continue
-			#Sanity/safety check
-			if option[0] not in program.valid_options:
-				continue
-			setattr(options, option[0], option[1])
+		session = Session(salt, self.client_address[0])
+		reader = socket.makefile('rb')
+		try:
+			option_list = read_request(reader)
+			if option_list is None:
+				return
+			encoder = protocol.negotiate(option_list)
+			socket.sendall(encoder.greeting)
 
+			while option_list is not None:
+				options, search = parse_options(program, option_list)
+				if not self.queue(socket, encoder, program, session, options, search):
+					break
+				if not encoder.session:
+					break
+				option_list = read_request(reader)
+		except OSError:
+			# The client went away
+			pass
+		finally:
+			# The socket isn't really closed while the file reading from it is open
+			reader.close()
+			socket.close()
+
+	def queue(self, socket, encoder, program, session, options, search):
+		"""Wait for a turn to run, telling the client how long the queue is, then search"""
+		changed = Event()
+		scheduler = self.server.scheduler
+		ticket = scheduler.submit(session.queue_key(options), changed.set)
+		try:
+			position = None
+			while True:
+				changed.clear()
+				new_position = scheduler.position(ticket)
+				if new_position is None:
+					break
+				if new_position != position:
+					socket.sendall(encoder.message(queue_message(new_position)))
+					position = new_position
+				changed.wait()
+
+			return self.search(socket, encoder, program, session, options, search)
+		finally:
+			scheduler.finish(ticket)
+
+	def search(self, socket, encoder, program, session, options, search):
+		"""Run a search and send its results, returning whether the client may search again"""
 		#if response[:5] != 'AUTH=':
 		#	socket.sendall('GO AWAY\n')
 		#	socket.close()
@@ -58,28 +250,190 @@ class QuasselGrepHandler(BaseRequestHandler):
 		#password = response[5:]
 
 		try:
-			query = program.run(options, search, salt)
+			query = program.run(options, search, session.salt, session.user)
 		except AuthException as e:
-			socket.sendall(('Error: %s\n' % (e)).encode('utf-8'))
-			socket.close()
+			socket.sendall(encoder.error(str(e)) + encoder.end())
+			return False
+		if query is None:
+			socket.sendall(encoder.error('The search could not be run.') + encoder.end())
+			return True
+
+		session.user = options.username
+		query.abandoned = lambda: client_gone(socket)
+		results = None
+		# Unless the query finishes normally, the connection is not reused
+		broken = True
+		try:
+			socket.sendall(encoder.message('Please wait for results...'))
+			results = query.run()
+			# Results are sent as they are formatted, so memory use doesn't grow with their number
+			for lines in results:
+				socket.sendall(encoder.results(lines) + encoder.token(getattr(lines, 'token', None)))
+			broken = False
+			socket.sendall(more_message(encoder, query) + encoder.end())
+		except ValueError as e:
+			broken = False
+			socket.sendall(encoder.error(str(e)) + encoder.end())
+		except OSError:
+			# The client went away, so nobody wants the rest of the results
+			query.cancel('The client went away')
+			return False
+		finally:
+			if results is not None:
+				results.close()
+			program.release(query.db, broken)
+		return True
+
+class AsyncServer(object):
+	"""Serves requests from one thread with asyncio
+
+	Rather than a thread per client, the database work is done in a pool of
+	options.workers threads. Clients wait their turn in the Scheduler's queue,
+	and results are only fetched as fast as the client reads them."""
+	def __init__(self, program, workers, scheduler):
+		self.program = program
+		self.executor = ThreadPoolExecutor(workers)
+		self.scheduler = scheduler
+
+	def call(self, function, *args):
+		"""Run a blocking function in the thread pool"""
+		return asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+	async def handle(self, reader, writer):
+		try:
+			await self.serve(reader, writer)
+		except (ConnectionError, asyncio.IncompleteReadError):
+			# The client went away
+			pass
+		finally:
+			writer.close()
+
+	async def serve(self, reader, writer):
+		request = (await reader.readline()).decode('utf-8').rstrip('\n')
+		if request != 'HI':
+			writer.write(b'GO AWAY\n')
 			return
 
-		socket.sendall(b'Please wait for results...\n')
-		results = query.run()
-		if results:
-			for res in results:
-				socket.sendall((query.format(res) + '\n').encode('utf-8'))
-			socket.close()
-		else:
-			socket.sendall(b'No results.\n')
+		salt = codecs.encode(urandom(32), 'hex').decode('ascii')
+		writer.write(('SALT=%s\n' % (salt)).encode('ascii'))
+
+		session = Session(salt, writer.get_extra_info('peername')[0])
+		option_list = await self.read_request(reader)
+		if option_list is None:
+			return
+		encoder = protocol.negotiate(option_list)
+		writer.write(encoder.greeting)
+
+		while option_list is not None:
+			options, search = parse_options(self.program, option_list)
+			if not await self.queue(reader, writer, encoder, session, options, search):
+				break
+			if not encoder.session:
+				break
+			option_list = await self.read_request(reader)
+
+	async def read_request(self, reader):
+		"""Read the lines of a request, ending with the search, or return None at the end of input"""
+		option_list = []
+		while True:
+			line = await reader.readline()
+			if not line:
+				return None
+			option_list.append(line.decode('utf-8').rstrip('\n'))
+			# The search is always sent last
+			if option_list[-1].startswith('SEARCH='):
+				return option_list
+
+	async def queue(self, reader, writer, encoder, session, options, search):
+		"""Wait for a turn to run, telling the client how long the queue is, then search"""
+		loop = asyncio.get_running_loop()
+		changed = asyncio.Event()
+		ticket = self.scheduler.submit(session.queue_key(options), lambda: loop.call_soon_threadsafe(changed.set))
+		try:
+			position = None
+			while True:
+				changed.clear()
+				new_position = self.scheduler.position(ticket)
+				if new_position is None:
+					break
+				if new_position != position:
+					writer.write(encoder.message(queue_message(new_position)))
+					position = new_position
+				await changed.wait()
+
+			return await self.search(reader, writer, encoder, session, options, search)
+		finally:
+			self.scheduler.finish(ticket)
+
+	async def search(self, reader, writer, encoder, session, options, search):
+		"""Run a search and send its results, returning whether the client may search again"""
+		try:
+			query = await self.call(self.program.run, options, search, session.salt, session.user)
+		except AuthException as e:
+			writer.write(encoder.error(str(e)) + encoder.end())
+			return False
+		if query is None:
+			writer.write(encoder.error('The search could not be run.') + encoder.end())
+			return True
+
+		session.user = options.username
+		writer.write(encoder.message('Please wait for results...'))
+		# Clients send nothing more after the search, so end of input means they have gone away
+		query.abandoned = reader.at_eof
+		results = None
+		# Unless the query finishes normally, the connection is not reused
+		broken = True
+		try:
+			await writer.drain()
+			results = await self.call(query.run)
+			while True:
+				lines = await self.call(next, results, None)
+				if lines is None:
+					break
+				writer.write(encoder.results(lines) + encoder.token(getattr(lines, 'token', None)))
+				# Wait for the client to catch up before fetching more
+				await writer.drain()
+			broken = False
+			writer.write(more_message(encoder, query) + encoder.end())
+		except ValueError as e:
+			broken = False
+			writer.write(encoder.error(str(e)) + encoder.end())
+		except ConnectionError:
+			query.cancel('The client went away')
+			raise
+		finally:
+			if results is not None:
+				await self.call(results.close)
+			await self.call(self.program.release, query.db, broken)
+		return True
+
+	async def serve_forever(self, host, port):
+		server = await asyncio.start_server(self.handle, host, port, reuse_address=True)
+		async with server:
+			await server.serve_forever()
 
 host = ''
 port = 9001
 def start(program, options):
+	if options.sync_interval:
+		from .index import SyncThread
+		SyncThread(options, options.sync_interval).start()
+
+	scheduler = Scheduler(options.max_queries, options.max_user_queries)
+
+	if options.async_server:
+		try:
+			asyncio.run(AsyncServer(program, options.workers, scheduler).serve_forever(host, port))
+		except KeyboardInterrupt:
+			pass
+		print("Finishing.")
+		return
+
 	ThreadingTCPServer.allow_reuse_address = True
 	server = ThreadingTCPServer((host, port), QuasselGrepHandler)
 	server.program = program
 	server.options = options
+	server.scheduler = scheduler
 
 	server.serve_forever()
 	print("Finishing.")
@@ -0,0 +1,80 @@
+"""Translating time ranges into ranges of message IDs
+
+Quassel does not index backlog.time, so without a hand-made index (see
+--setup-indexes) a search by time has to read the whole backlog. Message IDs
+are given out in the order messages are logged, though, so the first message
+at or after a given time can be found by a binary search on the primary key,
+and the time range turned into a range of IDs. This is only exact if times
+always increase with IDs, which is why it is optional (see --id-range.)
+
+The first message ID of each day is remembered, which narrows down the
+search for later queries."""
+
+from datetime import datetime, timedelta
+
+from .dimensions import PickledCache
+
+def id_bounds(cursor):
+	"""Return the lowest and highest message IDs"""
+	cursor.execute('SELECT MIN(messageid), MAX(messageid) FROM backlog')
+	low, high = cursor.fetchone()
+	return (low or 0, high or 0)
+
+def search(cursor, param_string, value, low, high):
+	"""Find the first message ID in [low, high) whose time is at least value
+
+	Returns high if there is no such message."""
+	probe = ('SELECT messageid, time >= %s FROM backlog WHERE messageid >= %s ORDER BY messageid LIMIT 1' %
+	         (param_string, param_string))
+
+	while low < high:
+		middle = (low + high) // 2
+		cursor.execute(probe, (value, middle))
+		row = cursor.fetchone()
+		if row is None or row[1]:
+			high = middle
+		else:
+			# There are no IDs between middle and this one
+			low = row[0] + 1
+
+	return low
+
+class Checkpoints(PickledCache):
+	"""Remembers the first message ID at or after the start of each day"""
+	def __init__(self, path=None):
+		PickledCache.__init__(self, path)
+		self.days = {}
+
+	def get_state(self):
+		return self.days
+
+	def set_state(self, state):
+		self.days = state
+
+	def first_id(self, query, when):
+		"""Return the ID of the first message at or after the datetime when
+
+		Returns one more than the highest ID if there is no such message."""
+		cursor = query.cursor.connection.cursor()
+		day = datetime(when.year, when.month, when.day)
+		low = self.day_id(query, cursor, day)
+		high = self.day_id(query, cursor, day + timedelta(days=1))
+		messageid = search(cursor, query.options.param_string, query.db_time(when), low, high)
+		cursor.close()
+		return messageid
+
+	def day_id(self, query, cursor, day):
+		"""Return the ID of the first message at or after the start of day"""
+		key = day.date()
+		if key in self.days:
+			return self.days[key]
+
+		low, high = id_bounds(cursor)
+		messageid = search(cursor, query.options.param_string, query.db_time(day), low, high + 1)
+
+		# Later messages get higher IDs, so once there is a message after the start of the day this can't change
+		if messageid <= high:
+			with self.lock:
+				self.days[key] = messageid
+				self.changed = True
+		return messageid
@@ -38,6 +38,7 @@ setup(
 
     extras_require = {
         "PostgreSQL": ["psycopg2"],
+        "Parquet": ["pyarrow"],
     },
 
     # See https://pypi.python.org/pypi?%3Aaction=list_classifiers for others
@@ -0,0 +1,78 @@
+"""The on-disk cache of results of searches over past time ranges (see rowcache.py)"""
+
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from quasselgrep import config, dimensions, rowcache
+from quasselgrep.__main__ import QuasselGrep
+from quasselgrep.db import Db
+from quasselgrep.query import Query, MAX_ID_LIST
+
+SENDERS = MAX_ID_LIST + 1
+TIMERANGE = [datetime(2020, 1, 1), datetime(2020, 1, 2)]
+
+def make_database(path):
+	"""Make a backlog where bob and carol each have more senders than fit in a list of IDs"""
+	connection = sqlite3.connect(path)
+	connection.executescript('''
+		CREATE TABLE coreinfo (key TEXT, value TEXT);
+		CREATE TABLE quasseluser (userid INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT, hashversion INTEGER);
+		CREATE TABLE network (networkid INTEGER PRIMARY KEY, userid INTEGER, networkname TEXT);
+		CREATE TABLE buffer (bufferid INTEGER PRIMARY KEY, userid INTEGER, groupid INTEGER, networkid INTEGER,
+		                     buffername TEXT, buffercname TEXT, buffertype INTEGER, lastmsgid INTEGER);
+		CREATE TABLE sender (senderid INTEGER PRIMARY KEY, sender TEXT, realname TEXT, avatarurl TEXT);
+		CREATE TABLE backlog (messageid INTEGER PRIMARY KEY, time INTEGER, bufferid INTEGER, type INTEGER, flags INTEGER,
+		                      senderid INTEGER, senderprefixes TEXT, message TEXT);
+		INSERT INTO coreinfo VALUES ('schemaversion', '31');
+		INSERT INTO quasseluser VALUES (1, 'alice', '', 1);
+		INSERT INTO network VALUES (1, 1, 'libera');
+		INSERT INTO buffer VALUES (1, 1, 0, 1, '#quassel', '#quassel', 2, 0);
+	''')
+	time = int(datetime(2020, 1, 1, 12).timestamp() * 1000)
+	for nick in ['bob', 'carol']:
+		for host in range(SENDERS):
+			connection.execute('INSERT INTO sender (sender) VALUES (?)', ('%s!~%s@host%d' % (nick, nick, host),))
+			connection.execute('INSERT INTO backlog (time, bufferid, type, flags, senderid, message) '
+			                   'VALUES (?, 1, 1, 0, last_insert_rowid(), ?)', (time, 'hello from %s' % (nick)))
+			time += 1000
+	connection.commit()
+	connection.close()
+
+@pytest.fixture
+def search(tmp_path, monkeypatch):
+	"""Return a function running a search on a new database, with the cache in tmp_path"""
+	monkeypatch.setattr(dimensions, 'CACHE_DIR', str(tmp_path / 'cache'))
+	monkeypatch.setattr(rowcache, 'CACHE_DIR', str(tmp_path / 'cache'))
+	database = str(tmp_path / 'quassel.sqlite')
+	make_database(database)
+	conf = tmp_path / 'quasselgrep.conf'
+	conf.write_text("config = {'db_name' : %r}\n" % (database))
+
+	program = QuasselGrep.__new__(QuasselGrep)
+	program.setup_optparser()
+
+	def run(*args):
+		options = program.parser.parse_args(['-c', str(conf), '--serial'] + list(args))
+		config.update_options(options)
+		db = Db()
+		try:
+			query = Query(db.connect(options), options, '%hello%', TIMERANGE)
+			assert query.row_cache is not None
+			return [line for lines in query.run() for line in lines]
+		finally:
+			db.close()
+	return run
+
+def test_searches_differing_only_in_temporary_ids(search, capsys):
+	bob = search('-n', 'bob')
+	carol = search('-n', 'carol')
+	assert len(bob) == len(carol) == SENDERS
+	assert all(line.endswith('<bob> hello from bob') for line in bob)
+	assert all(line.endswith('<carol> hello from carol') for line in carol)
+
+	# Repeating a search still uses the cache
+	capsys.readouterr()
+	assert search('-n', 'carol') == carol
+	assert 'answered from cache' in capsys.readouterr().out